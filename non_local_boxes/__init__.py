@@ -1,2 +1,11 @@
 from .utils import *
-from .evaluate import *
\ No newline at end of file
+from .evaluate import *
+from .search import *
+from .registry import *
+from .orbits import *
+from .collapse import *
+from .accumulator import *
+from .optimize import *
+from .scan import *
+from .regions import *
+from .multiplication import *
\ No newline at end of file
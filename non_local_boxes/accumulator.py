@@ -0,0 +1,86 @@
+import torch
+
+
+#
+#   Streaming statistics of the values of phi_flat
+#
+
+# The values are given chunk by chunk, and only the following statistics are kept (in a memory that does
+# not depend on the number of values): a histogram with `bins` bins on [low, high], the number of values,
+# their minimum, maximum and sum, a finer histogram with `quantile_bins` bins to compute the quantiles (up to
+# (high-low)/quantile_bins), and the k largest values with their wirings. The values outside [low, high]
+# are counted in the first or the last bin. Two accumulators with the same parameters can be merged.
+
+class Accumulator:
+
+    def __init__(self, bins=100, k=10, low=0., high=1., quantile_bins=2**16):
+        self.bins, self.k, self.low, self.high, self.quantile_bins = bins, k, low, high, quantile_bins
+        self.counts = torch.zeros(bins, dtype=torch.int64)
+        self.quantile_counts = torch.zeros(quantile_bins, dtype=torch.int64)
+        self.count, self.total = 0, 0.
+        self.min, self.max = float("inf"), float("-inf")
+        self.values, self.wirings = torch.zeros(0), torch.zeros(32, 0)
+
+    def bin_indices(self, values, bins):
+        return torch.clamp(((values - self.low) / (self.high - self.low) * bins).long(), 0, bins-1)
+
+    def update(self, values, W=None):
+        # values is a tensor with n entries, W is the 32xn matrix of the corresponding wirings (optional)
+        values = values.detach()
+        if values.shape[0] == 0:
+            return
+        self.counts += torch.bincount(self.bin_indices(values, self.bins), minlength=self.bins)
+        self.quantile_counts += torch.bincount(self.bin_indices(values, self.quantile_bins), minlength=self.quantile_bins)
+        self.count += values.shape[0]
+        self.total += float(torch.sum(values.double()))
+        self.min, self.max = min(self.min, float(torch.min(values))), max(self.max, float(torch.max(values)))
+        if W is not None:
+            self.keep_best(values, W.detach())
+
+    def keep_best(self, values, W):
+        values, W = torch.cat((self.values, values)), torch.cat((self.wirings, W), dim=1)
+        values, best = torch.topk(values, min(self.k, values.shape[0]))
+        self.values, self.wirings = values, W[:, best]
+
+    def merge(self, other):
+        if (self.bins, self.k, self.low, self.high, self.quantile_bins) != (other.bins, other.k, other.low, other.high, other.quantile_bins):
+            raise ValueError("Only accumulators with the same parameters can be merged.")
+        self.counts += other.counts
+        self.quantile_counts += other.quantile_counts
+        self.count += other.count
+        self.total += other.total
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.keep_best(other.values, other.wirings)
+        return self
+
+    def mean(self):
+        if self.count == 0:
+            return float("nan")
+        return self.total / self.count
+
+    def quantile(self, q):  # q is a number in [0,1]
+        if self.count == 0:
+            return float("nan")
+        cumulative = torch.cumsum(self.quantile_counts, dim=0)
+        index = int(torch.searchsorted(cumulative, torch.tensor(max(1, q*self.count))))
+        value = self.low + (index + 0.5) * (self.high - self.low) / self.quantile_bins
+        return min(max(value, self.min), self.max)
+        # the output is a number: the q-quantile of the values, up to (high-low)/quantile_bins (nan if there is
+        # no value)
+
+    def bin_edges(self):
+        return torch.linspace(self.low, self.high, self.bins+1)
+
+    def state_dict(self):
+        return {key: getattr(self, key) for key in ("bins", "k", "low", "high", "quantile_bins", "counts", "quantile_counts", "count", "total", "min", "max", "values", "wirings")}
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path)
+        accumulator = cls(state["bins"], state["k"], state["low"], state["high"], state["quantile_bins"])
+        for key in state:
+            setattr(accumulator, key, state[key])
+        return accumulator
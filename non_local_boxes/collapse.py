@@ -0,0 +1,210 @@
+import torch
+import non_local_boxes.evaluate
+import non_local_boxes.optimize
+import non_local_boxes.regions
+import non_local_boxes.search
+import non_local_boxes.utils
+
+
+#
+#   Collapsing boxes
+#
+
+# A box P collapses communication complexity as soon as it wins the CHSH game with a probability larger than
+# the [BBLMTU06] value (3+sqrt(6))/6. If it is not the case, we look at the powers of P: at step l, the three
+# boxes Qright = Qright x_W P, Qcenter = Qcenter x_W Qcenter and Qleft = P x_W Qleft (starting from P) are
+# computed, and P is collapsing as soon as one of them wins CHSH above the threshold.
+
+BBLMTU_value = non_local_boxes.utils.BBLMTU_value
+
+
+def collapse_depths(W, P, max_power, threshold=BBLMTU_value):
+    # W is a 32xm matrix, P is a 4x4xm tensor: each column is tested with its own wiring
+    # Only the boxes that did not collapse yet are multiplied, and the three products of a step are
+    # computed in a single call to R.
+    depth = torch.full((P.shape[2],), -1, dtype=torch.int64)
+    with torch.no_grad():
+        depth[non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(P)) > threshold] = 0
+        active = torch.nonzero(depth < 0).squeeze(1)
+        Qright, Qcenter, Qleft = P[:, :, active], P[:, :, active], P[:, :, active]
+        for l in range(max_power):
+            k = active.shape[0]
+            if k == 0:
+                break
+            Pa, Wa = P[:, :, active], W[:, active]
+            products = non_local_boxes.evaluate.R(torch.cat((Wa, Wa, Wa), dim=1), torch.cat((Qright, Qcenter, Pa), dim=2), torch.cat((Pa, Qcenter, Qleft), dim=2))
+            values = torch.reshape(non_local_boxes.evaluate.h_flat(products), (3, k)).max(dim=0).values
+            products = non_local_boxes.utils.tensor_to_matrix(products)
+            left = values <= threshold
+            depth[active[~left]] = l+1
+            active = active[left]
+            Qright, Qcenter, Qleft = products[:, :, :k][:, :, left], products[:, :, k:2*k][:, :, left], products[:, :, 2*k:][:, :, left]
+    return depth
+    # the output is a int64 tensor with m entries: the number of steps needed to collapse (0 if P itself is
+    # collapsing), or -1 if the box did not collapse after max_power steps
+
+
+def triangle_grid(grid_size):
+    # Barycentric coordinates (alpha, beta) of the points i/grid_size, j/grid_size with i+j <= grid_size
+    coefficients = non_local_boxes.regions.grid_coefficients(grid_size)
+    return coefficients[0], coefficients[1]
+    # the output is two tensors with m = (grid_size+1)(grid_size+2)/2 entries
+
+
+def collapse_map(W, Box1, Box2, Box3, grid_size, max_power, threshold=BBLMTU_value):
+    # W is a vector of size 32 (or a 32x1 matrix), Box1, Box2, Box3 are 4x4 matrices
+    # Tests all the boxes alpha*Box1 + beta*Box2 + (1-alpha-beta)*Box3 of triangle_grid(grid_size) at once
+    P = non_local_boxes.regions.Triangle(Box1, Box2, Box3).grid(grid_size)
+    W = torch.reshape(W, (32, 1)).expand(32, P.shape[2])
+    return collapse_depths(W, P, max_power, threshold)
+    # the output is a int64 tensor with m entries (see collapse_depths), in the order of triangle_grid(grid_size)
+
+
+def collapse_segment(W, Box1, Box3, grid_size, max_power, threshold=BBLMTU_value):
+    # W is a vector of size 32 (or a 32x1 matrix), Box1 and Box3 are 4x4 matrices
+    # Tests the boxes alpha*Box1 + (1-alpha)*Box3 for alpha = 0, 1/grid_size, ..., 1
+    P = non_local_boxes.regions.Triangle(Box1, Box3, Box3).segment(grid_size)
+    W = torch.reshape(W, (32, 1)).expand(32, P.shape[2])
+    return collapse_depths(W, P, max_power, threshold)
+    # the output is a int64 tensor with grid_size+1 entries (see collapse_depths)
+
+
+
+#
+#   Screening of many wirings
+#
+
+# As in `Test_Wiring`, each wiring is tested on the triangles PR, fixed box, P_L^{mu nu sigma tau}, for the
+# 16 local boxes of `utils.boxes_to_be_tested`. All the (wiring, triangle, grid point) triples of a chunk of
+# wirings are tested at once, and the chunks can be shared between several processes.
+
+local_boxes = torch.stack([non_local_boxes.utils.P_L(*box) for box in non_local_boxes.utils.boxes_to_be_tested], dim=2)  # 4x4x16 tensor
+
+
+def screen_chunk(W, fixed_box, grid_size, max_power, threshold, segment_grid_size, segment_max_power, good_proportion):
+    # W is a 32xc matrix, fixed_box is a 4x4 matrix
+    c = W.shape[1]
+    P = non_local_boxes.regions.Triangle(non_local_boxes.utils.PR, fixed_box, fixed_box).segment(segment_grid_size)
+    P = torch.unsqueeze(P, 2).expand(4, 4, c, P.shape[2])
+    Wc = torch.unsqueeze(W, 2).expand(32, c, P.shape[3])
+    depth = collapse_depths(torch.reshape(Wc, (32, -1)), torch.reshape(P, (4, 4, -1)), segment_max_power, threshold)
+    segment = (torch.reshape(depth, (c, -1)) >= 0).float().mean(dim=1)
+
+    table = torch.full((c, 16), float("nan"))
+    tested = torch.nonzero(segment >= good_proportion).squeeze(1)
+    triangles = torch.nonzero(torch.reshape(local_boxes != torch.unsqueeze(fixed_box, 2), (16, 16)).any(dim=0)).squeeze(1)
+    if tested.shape[0] > 0:
+        P = torch.stack([non_local_boxes.regions.Triangle(non_local_boxes.utils.PR, fixed_box, local_boxes[:, :, t]).grid(grid_size) for t in triangles.tolist()], dim=2)
+        shape = (tested.shape[0], triangles.shape[0], P.shape[3])
+        P = torch.unsqueeze(P, 2).expand(4, 4, *shape)
+        Wc = W[:, tested, None, None].expand(32, *shape)
+        depth = collapse_depths(torch.reshape(Wc, (32, -1)), torch.reshape(P, (4, 4, -1)), max_power, threshold)
+        table[tested[:, None], triangles] = (torch.reshape(depth, shape) >= 0).float().mean(dim=2)
+    return segment, table
+
+
+def screen_chunk_in_worker(args):
+    return screen_chunk(*args)
+
+
+def screen_wirings(W, fixed_box, grid_size=60, max_power=10, threshold=BBLMTU_value, segment_grid_size=40, segment_max_power=40, good_proportion=0., wirings_per_chunk=4, nb_workers=1, threads_per_worker=1):
+    # W is a 32xc matrix of candidate wirings, fixed_box is a 4x4 matrix
+    # For each wiring, first computes the proportion of collapsing boxes in the segment PR -- fixed box; the
+    # triangles are only tested for the wirings with a proportion at least good_proportion (0.4 in Test_Wiring).
+    jobs = [(W[:, start:start+wirings_per_chunk], fixed_box, grid_size, max_power, threshold, segment_grid_size, segment_max_power, good_proportion) for start in range(0, W.shape[1], wirings_per_chunk)]
+    if nb_workers > 1:
+        with torch.multiprocessing.get_context("spawn").Pool(nb_workers, initializer=non_local_boxes.search.init_worker, initargs=(threads_per_worker,)) as pool:
+            results = pool.map(screen_chunk_in_worker, jobs)
+    else:
+        results = list(map(screen_chunk_in_worker, jobs))
+    return torch.cat([segment for segment, _ in results]), torch.cat([table for _, table in results])
+    # the output is a tensor with c entries (the proportions in the segment), and a cx16 tensor: the proportion
+    # of collapsing boxes in each triangle, in the order of utils.boxes_to_be_tested (nan if the triangle is not
+    # tested: if the wiring failed the segment test, or if the local box is the fixed box)
+
+
+
+#
+#   Collapse tests of [BS09] and of Algorithm 4
+#
+
+def is_in_BS09(P, max_power, threshold=BBLMTU_value):
+    # P is a 4x4 matrix
+    # Tests P, P x P, (P x P) x (P x P), ... with the wiring of [BS09], up to max_power squarings
+    W = non_local_boxes.utils.W_BS09(1).detach()
+    with torch.no_grad():
+        value = float(non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(P)))
+        for depth in range(max_power+1):
+            if depth > 0:
+                P = non_local_boxes.utils.tensor_to_matrix(non_local_boxes.evaluate.R(W, P, P)[:, :, :, :, 0])
+                value = float(non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(P)))
+            if value > threshold:
+                return True, depth, value
+    return False, max_power, value
+    # the output is (collapsing or not, number of squarings, CHSH value of the last box)
+
+
+def is_in_here_batch(P, max_power, optimizer=None, m=1000, threshold=BBLMTU_value):
+    # P is a 4x4xB tensor (B boxes), optimizer is a `optimize.LineSearchWithResets` (by default, the one of the article)
+    # cf. "Algorithm 4" in the article: P_{k+1} = P_k x_W P, where W is the best wiring found by the optimizer
+    # (with m columns) for phi_flat(W, P_k, P). The B boxes are optimized together (B*m columns), and a box
+    # is not multiplied anymore once it is collapsing.
+    if optimizer is None:
+        optimizer = non_local_boxes.optimize.LineSearchWithResets(LS_iterations=20, K_reset=10, chi=0.1)
+    B = P.shape[2]
+    collapsed, depth = torch.zeros(B, dtype=torch.bool), torch.full((B,), max_power)
+    chsh, wirings = torch.zeros(B), torch.zeros(32, B)
+    Pn, active = P.clone(), torch.arange(B)
+    for k in range(1, max_power+1):
+        if active.shape[0] == 0:
+            break
+        Pa, Pna = P[:, :, active], Pn[:, :, active]
+        W = optimizer.run(Pna, Pa, m)
+        values = non_local_boxes.optimize.phi_flat_in_chunks(W, torch.repeat_interleave(Pna, m, dim=2), torch.repeat_interleave(Pa, m, dim=2), optimizer.chunk_size)
+        W = W[:, torch.argmax(torch.reshape(values, (-1, m)), dim=1) + m*torch.arange(active.shape[0])]
+        with torch.no_grad():
+            Pna = non_local_boxes.utils.tensor_to_matrix(non_local_boxes.evaluate.R(W, Pna, Pa))
+            value = non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(Pna))
+        Pn[:, :, active], chsh[active], wirings[:, active] = Pna, value, W
+        done = value > threshold
+        collapsed[active[done]], depth[active[done]] = True, k
+        active = active[~done]
+    return collapsed, depth, chsh, wirings
+    # the output is, for each box: collapsing or not, number of products, CHSH value of the last box, and the
+    # last wiring (a 32xB matrix)
+
+
+def is_in_here(P, max_power, optimizer=None, m=1000, threshold=BBLMTU_value):
+    # P is a 4x4 matrix (see is_in_here_batch)
+    collapsed, depth, chsh, wirings = is_in_here_batch(torch.unsqueeze(P, 2), max_power, optimizer, m, threshold)
+    return bool(collapsed[0]), int(depth[0]), float(chsh[0]), wirings[:, 0]
+    # the output is (collapsing or not, number of products, CHSH value of the last box, last wiring)
+
+
+def triangle_boxes(P1, P2, P3, alpha, gamma):
+    # P1, P2, P3 are 4x4 matrices, alpha and gamma are tensors with B entries
+    return non_local_boxes.regions.Triangle(P1, P2, P3).mixtures(alpha, gamma)
+    # the output is the 4x4xB tensor of the boxes alpha*P1 + (1-alpha-gamma)*P2 + gamma*P3 (as in `scan.collapse_scan`)
+
+
+def is_in_here_chunk(P, max_power, optimizer, m, threshold, seed):
+    torch.manual_seed(seed)
+    return is_in_here_batch(P, max_power, optimizer, m, threshold)
+
+
+def is_in_here_chunk_in_worker(args):
+    return is_in_here_chunk(*args)
+
+
+def is_in_here_pool(P, max_power, optimizer=None, m=1000, threshold=BBLMTU_value, boxes_per_chunk=16, seed=0, nb_workers=1, threads_per_worker=1):
+    # P is a 4x4xB tensor (see is_in_here_batch)
+    # The boxes are tested boxes_per_chunk at a time, on nb_workers processes. The chunk c is computed after
+    # torch.manual_seed(seed + c), so the output does not depend on nb_workers.
+    jobs = [(P[:, :, start:start+boxes_per_chunk], max_power, optimizer, m, threshold, seed + chunk) for chunk, start in enumerate(range(0, P.shape[2], boxes_per_chunk))]
+    if nb_workers > 1:
+        with torch.multiprocessing.get_context("spawn").Pool(nb_workers, initializer=non_local_boxes.search.init_worker, initargs=(threads_per_worker,)) as pool:
+            results = pool.map(is_in_here_chunk_in_worker, jobs)
+    else:
+        results = list(map(is_in_here_chunk_in_worker, jobs))
+    return tuple(torch.cat([result[i] for result in results], dim=-1) for i in range(4))
+    # the output is the same as for is_in_here_batch
@@ -2,7 +2,7 @@ import torch
 import non_local_boxes.utils
 
 
-nb_columns = int(1e0)
+nb_columns = int(1e0)   # only a default for the notebooks: every function below accepts a 32xn wiring W of any n
 
 
 #
@@ -35,14 +35,13 @@ for x in range(2):
         A1[x, 3, j, 3] = sign*(-x)
 
 
-# A2 is a 2x4x4xn tensor
-A2 = torch.zeros( (2, 4, 4, nb_columns) )
+# A2 is a 2x4x4x1 tensor (it is broadcast along the n columns of W)
+A2 = torch.zeros( (2, 4, 4, 1) )
 for x in range(2):
     for i in range(4):
         for k in range(4):
-            for alpha in range(nb_columns):
-                if k<=1:
-                    A2[x, i, k]=1
+            if k<=1:
+                A2[x, i, k]=1
 
 
 # A3 is a 2x4x4x32-tensor
@@ -65,14 +64,13 @@ for y in range(2):
         A3[y, 3, j, 3 +4] = sign*(-y)
 
 
-# A4 is a 2x4x4xn-tensor
-A4 = torch.zeros( (2, 4, 4, nb_columns) )
+# A4 is a 2x4x4x1-tensor (it is broadcast along the n columns of W)
+A4 = torch.zeros( (2, 4, 4, 1) )
 for y in range(2):
     for i in range(4):
         for k in range(4):
-            for alpha in range(nb_columns):
-                if k==0 or k==2:
-                    A4[y, i, k]=1
+            if k==0 or k==2:
+                A4[y, i, k]=1
 
 
 def A(W):    # W is a 32xn matrix
@@ -185,13 +183,12 @@ for a in range(2):
                 C1[a, x, 3, j, 5 +18] = -(x) * (-1)**a
 
 
-# C2 is a 2x2x4x4xnb_columns-tensor
-C2 = torch.zeros( (2, 2, 4, 4, nb_columns) )
+# C2 is a 2x2x4x4x1-tensor (it is broadcast along the n columns of W)
+C2 = torch.zeros( (2, 2, 4, 4, 1) )
 for x in range(2):
     for i in range(4):
         for j in range(4):
-            for alpha in range(nb_columns):
-                C2[0, x, i, j]=1
+            C2[0, x, i, j]=1
 
 
 def C(W):    # W is a 32xn matrix
@@ -240,13 +237,12 @@ for b in range(2):
                 D1[b, y, 1, j, 5 + 26] = -(y) * (-1)**b
                 D1[b, y, 3, j, 5 + 26] = -(y) * (-1)**b
 
-# D2 is a 2x2x4x4xnb_columns-tensor
-D2 = torch.zeros( (2, 2, 4, 4, nb_columns) )
+# D2 is a 2x2x4x4x1-tensor (it is broadcast along the n columns of W)
+D2 = torch.zeros( (2, 2, 4, 4, 1) )
 for y in range(2):
     for i in range(4):
         for j in range(4):
-            for alpha in range(nb_columns):
-                D2[0, y, i, j] = 1
+            D2[0, y, i, j] = 1
 
 def D(W):    # W is a 32xn matrix
     T1 = torch.tensordot(D1, W, dims=1) + D2
@@ -265,22 +261,25 @@ def D(W):    # W is a 32xn matrix
 #   R(W, P, Q) := P x_W Q
 #
 
-def R(W, P, Q):     # W is a 32xn matrix, P and Q are 4x4 matrices
-    T1 = torch.tensordot(A(W), P, dims=1)  # green term
-    T2 = torch.transpose(torch.tensordot(B(W), Q, dims=1), 4, 3)  # blue term
-    T3 = (T1*T2).repeat(2,2,1,1,1,1,1)
-    T4 = T3 * C(W) * D(W)  # the big bracket
-    return torch.tensordot(T4, torch.ones((4, 4)), dims=2)
+def box_term(T, S, P):     # T and S are 2x4x4xn tensors, P is a 4x4 matrix or a 4x4xn tensor (one box per column)
+    if P.dim() == 2:
+        return torch.einsum('xiqn,yiqn,qj->xyijn', T, S, P)
+    TS = T.unsqueeze(1) * S.unsqueeze(0)
+    return sum(TS[:, :, :, q].unsqueeze(3) * P[q] for q in range(4))  # cheaper than a batched einsum over the n columns
+    # the output is a 2x2x4x4xn tensor
+
+def R(W, P, Q):     # W is a 32xn matrix, P and Q are 4x4 matrices (or 4x4xn tensors: one box for each column of W)
+    # Same terms as in the PDF, but the products of A(W), B(W), C(W) and D(W) are contracted
+    # directly, so that the repeated 2x2x2x2xnx4x4 tensors are never built.
+    green = box_term(torch.tensordot(A1, W, dims=1) + A2, torch.tensordot(A3, W, dims=1) + A4, P)
+    blue = torch.transpose(box_term(torch.tensordot(B1, W, dims=1) + B2, torch.tensordot(B3, W, dims=1) + B4, Q), 2, 3)
+    return torch.einsum('xyijn,axijn,byijn->abxyn', green*blue, torch.tensordot(C1, W, dims=1) + C2, torch.tensordot(D1, W, dims=1) + D2)  # the big bracket
     # the output is a 2x2x2x2xn tensor
 
-def R_tensor(W, P, Q):     # W is a 32xn matrix, P and Q are 2x2x2x2 tensors
+def R_tensor(W, P, Q):     # W is a 32xn matrix, P and Q are 2x2x2x2 tensors (or 2x2x2x2xn tensors)
     P = non_local_boxes.utils.tensor_to_matrix(P)
     Q = non_local_boxes.utils.tensor_to_matrix(Q)
-    T1 = torch.tensordot(A(W), P, dims=1)  # green term
-    T2 = torch.transpose(torch.tensordot(B(W), Q, dims=1), 4, 3)  # blue term
-    T3 = (T1*T2).repeat(2,2,1,1,1,1,1)
-    T4 = T3 * C(W) * D(W)  # the big bracket
-    return torch.tensordot(T4, torch.ones((4, 4)), dims=2)
+    return R(W, P, Q)
     # the output is a 2x2x2x2xn tensor
 
 
@@ -299,6 +298,13 @@ def h_prime_flat(R):  # R is a 2x2x2x2xn tensor
     return torch.tensordot( non_local_boxes.utils.CHSH_prime_flat, R, dims=1 )  # scalar product of CHSH and each column of R
 
 
+def evaluate_games(R, games=None):  # R is a 2x2x2x2xn tensor, games is a Gx16 tensor (by default, utils.registered_games())
+    if games is None:
+        games = non_local_boxes.utils.registered_games()
+    return torch.matmul(games, torch.reshape(R, (16, -1)))
+    # the output is a Gxn tensor: the winning probability of each game (row) for each box (column)
+
+
 
 
 #
@@ -314,35 +320,174 @@ def phi_flat(W, P, Q):
     # the output is a list of numbers between 0 and 1 (n terms)
 
 
+def box_term_gradient(T, S, P, U, M1, M3):
+    # U is the derivative of a function with respect to box_term(T, S, P), where T = M1.W + M2 and S = M3.W + M4
+    if P.dim() == 2:
+        UP = torch.einsum('xyijn,qj->xyiqn', U, P)
+    else:
+        UP = torch.sum(torch.unsqueeze(U, 3) * P, dim=4)   # P[q, j, n] is broadcast as the dimensions 3, 4, 5 of U
+    gradient = torch.mm(torch.reshape(M1, (32, 32)).t(), torch.reshape(torch.sum(UP * torch.unsqueeze(S, 0), dim=1), (32, -1)))
+    return gradient + torch.mm(torch.reshape(M3, (32, 32)).t(), torch.reshape(torch.sum(UP * torch.unsqueeze(T, 1), dim=0), (32, -1)))
+    # the output is the 32xn matrix of the derivatives with respect to W
+
+
+def phi_and_grad(W, P, Q):
+    # W is a 32xn matrix, P and Q are 4x4 matrices (or 4x4xn tensors: one box for each column of W)
+    # Same value as phi_flat, with its exact gradient with respect to W, without autograd. We write
+    # phi = sum_{x,y,i,j} green * blue * K, where K = sum_{a,b} CHSH[a,b,x,y] C[a,x,i,j] D[b,y,i,j]: it is
+    # linear in each of the factors of green, blue, C and D, which are affine in W.
+    T, S = torch.tensordot(A1, W, dims=1) + A2, torch.tensordot(A3, W, dims=1) + A4
+    Tp, Sp = torch.tensordot(B1, W, dims=1) + B2, torch.tensordot(B3, W, dims=1) + B4
+    C, D = torch.tensordot(C1, W, dims=1) + C2, torch.tensordot(D1, W, dims=1) + D2
+    green = box_term(T, S, P)
+    blue = torch.transpose(box_term(Tp, Sp, Q), 2, 3)
+    CHSH = torch.reshape(non_local_boxes.utils.CHSH_flat, (2, 2, 2, 2))
+    CHSH_C = torch.einsum('abxy,axijn->bxyijn', CHSH, C)
+    green_blue = green*blue
+    gradient = torch.mm(torch.reshape(D1, (64, 32)).t(), torch.reshape(torch.sum(CHSH_C * torch.unsqueeze(green_blue, 0), dim=1), (64, -1)))
+    K = torch.sum(CHSH_C * torch.unsqueeze(D, 1), dim=0)
+    value = torch.sum(green_blue*K, dim=(0, 1, 2, 3))
+    gradient += torch.mm(torch.reshape(C1, (64, 32)).t(), torch.reshape(torch.sum(torch.einsum('abxy,byijn->axyijn', CHSH, D) * torch.unsqueeze(green_blue, 0), dim=2), (64, -1)))
+    gradient += box_term_gradient(T, S, P, blue*K, A1, A3)
+    gradient += box_term_gradient(Tp, Sp, Q, torch.transpose(green*K, 2, 3), B1, B3)
+    return value, gradient
+    # the output is the list of the n values of phi_flat, and the 32xn matrix of its gradient
+
+
+def polynomial_product(F, G):  # F and G are lists of coefficients (tensors), starting from the constant one
+    H = [0]*(len(F)+len(G)-1)
+    for k in range(len(F)):
+        for l in range(len(G)):
+            H[k+l] = H[k+l] + F[k]*G[l]
+    return H
+
+
+def phi_along_line(W, G, P, Q):
+    # W and G are 32xn matrices, P and Q are 4x4 matrices
+    # Each of A(W), B(W), C(W), D(W) is affine in W, so R(W + alpha*G, P, Q) is a polynomial of degree 6
+    # in alpha. Its coefficients are computed from the constant parts (A2, ...), the W-linear parts and the
+    # G-linear parts, each of them computed only once.
+    T = [torch.tensordot(A1, W, dims=1) + A2, torch.tensordot(A1, G, dims=1)]
+    S = [torch.tensordot(A3, W, dims=1) + A4, torch.tensordot(A3, G, dims=1)]
+    green = [box_term(T[0], S[0], P), box_term(T[0], S[1], P) + box_term(T[1], S[0], P), box_term(T[1], S[1], P)]
+    T = [torch.tensordot(B1, W, dims=1) + B2, torch.tensordot(B1, G, dims=1)]
+    S = [torch.tensordot(B3, W, dims=1) + B4, torch.tensordot(B3, G, dims=1)]
+    blue = [torch.transpose(box_term(T[0], S[0], Q), 2, 3), torch.transpose(box_term(T[0], S[1], Q) + box_term(T[1], S[0], Q), 2, 3), torch.transpose(box_term(T[1], S[1], Q), 2, 3)]
+    C = [torch.tensordot(C1, W, dims=1) + C2, torch.tensordot(C1, G, dims=1)]
+    D = [torch.tensordot(D1, W, dims=1) + D2, torch.tensordot(D1, G, dims=1)]
+    # h_flat is linear: the CHSH coefficients are contracted with C and D before the big bracket
+    CHSH = torch.reshape(non_local_boxes.utils.CHSH_flat, (2, 2, 2, 2))
+    C = [torch.einsum('abxy,axijn->bxyijn', CHSH, C[0]), torch.einsum('abxy,axijn->bxyijn', CHSH, C[1])]
+    CD = polynomial_product(C, [torch.unsqueeze(D[0], 1), torch.unsqueeze(D[1], 1)])
+    CD = [torch.reshape(torch.sum(term, dim=0), (64, -1)) for term in CD]
+    GB = [torch.reshape(term, (64, -1)) for term in polynomial_product(green, blue)]
+    return torch.stack([torch.sum(sum(GB[k]*CD[d-k] for k in range(max(0, d-2), min(d, 4)+1)), dim=0) for d in range(7)])
+    # the output is a 7xn tensor: phi_flat(W + alpha*G, P, Q) = sum_k output[k] * alpha**k, for each column
+
+
+def polynomial_value(coefficients, alpha):  # coefficients is a dxn tensor, alpha is a tensor with n entries
+    value = coefficients[-1]
+    for k in range(coefficients.shape[0]-2, -1, -1):
+        value = value*alpha + coefficients[k]
+    return value
+    # the output is a tensor with n entries
+
+
 
 def phi_power(W, P, N):
     # W is a 32xn matrix
     # P is a box: a 4x4 matrix
     # N is the power of P
-
-    Q = torch.zeros(N+1,2,2,2,2,nb_columns)
-    Q[2,:,:,:,:,:] = R(W, P, P) 
-    for k in range(N-2):
-        for alpha in range(nb_columns):
-            Q[k+3,:,:,:,:,alpha] = R(W, non_local_boxes.utils.tensor_to_matrix(Q[k+2,:,:,:,:,alpha]), P)[:,:,:,:,alpha]
-
-    
-    return h_flat( Q[N,:,:,:,:,:] )
+    return h_flat( box_power_recursive(W, P, N) )
     # the output is a list of numbers between 0 and 1 (n terms)
 
 
 
 def box_power_recursive(W, P, N):
+    # W is a 32xn matrix, P is a 4x4 matrix
+    # Column alpha of the output is (...((P x_W P) x_W P)...) x_W P with the wiring W[:, alpha]
     if N==1:
         return P
-    if N==2:
-        return R(W, P, P) 
-    Q = box_power_recursive(W,P,N-1)
-    Q_prime = torch.zeros_like(Q)
-    for alpha in range(nb_columns):
-        Q_prime[:,:,:,:,alpha] = R(W, non_local_boxes.utils.tensor_to_matrix(Q[:,:,:,:,alpha]), P)[:,:,:,:,alpha]
-    return Q_prime
+    Q = R(W, P, P)
+    for _ in range(N-2):
+        Q = R(W, non_local_boxes.utils.tensor_to_matrix(Q), P)  # one box per column
+    return Q
+    # the output is a 2x2x2x2xn tensor
 
 
 def phi_power_recursive(W, P, N):
-    return h_flat(box_power_recursive(W, P, N))
\ No newline at end of file
+    return h_flat(box_power_recursive(W, P, N))
+
+
+
+#
+#   Box powers for any parenthesization
+#
+
+# A parenthesization of a product of N copies of P is a binary tree: either 1 (the box P itself),
+# or a pair (left, right) of trees, for the product left x_W right.
+
+def power_tree(N, scheme="left"):
+    if N==1:
+        return 1
+    if scheme=="left":  # (...((P x P) x P)...) x P
+        return (power_tree(N-1, scheme), 1)
+    if scheme=="right":  # P x (P x (... x (P x P)...))
+        return (1, power_tree(N-1, scheme))
+    if scheme=="squaring":  # as in [BS09]: P^2 = P x P, P^4 = P^2 x P^2, ..., and one more x P for odd powers
+        half = power_tree(N//2, scheme)
+        if N%2==0:
+            return (half, half)
+        return ((half, half), 1)
+    raise ValueError("Unknown scheme: " + str(scheme))
+
+
+def number_of_leaves(tree):
+    if tree==1:
+        return 1
+    return number_of_leaves(tree[0]) + number_of_leaves(tree[1])
+
+
+def binary_trees(N):
+    # All the parenthesizations of a product of N boxes (there are Catalan(N-1) of them)
+    if N==1:
+        return [1]
+    return [(left, right) for l in range(1, N) for left in binary_trees(l) for right in binary_trees(N-l)]
+
+
+def box_product_tree(W, P, tree, cache):
+    # W is a 32xn matrix, P is a 4x4 matrix
+    # cache is a dictionary tree -> product, shared by all the calls with the same W and P
+    if tree==1:
+        return P
+    if tree not in cache:
+        left = box_product_tree(W, P, tree[0], cache)
+        right = box_product_tree(W, P, tree[1], cache)
+        cache[tree] = non_local_boxes.utils.tensor_to_matrix(R(W, left, right))
+    return cache[tree]
+    # the output is a 4x4xn tensor (or the 4x4 matrix P)
+
+
+def box_power(W, P, N, scheme="left", cache=None):
+    # W is a 32xn matrix, P is a 4x4 matrix
+    # scheme is "left", "right", "squaring", or a binary tree with N leaves
+    # The subproducts are stored in cache (a dictionary), which can be reused for other powers of P with W
+    if cache is None:
+        cache = {}
+    tree = scheme if isinstance(scheme, tuple) or scheme==1 else power_tree(N, scheme)
+    if number_of_leaves(tree) != N:
+        raise ValueError("The tree " + str(tree) + " is not a product of " + str(N) + " boxes.")
+    Q = box_product_tree(W, P, tree, cache)
+    if Q.dim()==2:
+        Q = Q.unsqueeze(-1).expand(4, 4, W.shape[1])
+    return non_local_boxes.utils.matrix_to_tensor(Q)
+    # the output is a 2x2x2x2xn tensor
+
+
+def box_orbit(W, P, max_depth):
+    # W is a 32xn matrix, P is a 4x4 matrix
+    # The orbit of depth k is the list of all products of k copies of P, for all the parenthesizations;
+    # each subproduct is computed once.
+    cache = {}
+    return [[box_power(W, P, k, tree, cache) for tree in binary_trees(k)] for k in range(1, max_depth+1)]
+    # the output is a list of max_depth lists of 2x2x2x2xn tensors
@@ -0,0 +1,119 @@
+import numpy
+import scipy.optimize
+import scipy.sparse
+import torch
+import non_local_boxes.evaluate
+import non_local_boxes.utils
+
+
+#
+#   Extremal boxes of NS
+#
+
+# The 24 extremal boxes, in the order of Multiplication-Table.ipynb: for each (mu, nu, sigma), the box
+# P_NL(mu, nu, sigma) and then the boxes P_L(mu, nu, sigma, tau).
+extremal_boxes = []
+extremal_box_names = []
+for mu in range(2):
+    for nu in range(2):
+        for sigma in range(2):
+            extremal_boxes.append(non_local_boxes.utils.P_NL(mu, nu, sigma))
+            extremal_box_names.append("PNL("+str(mu)+str(nu)+str(sigma)+")")
+            for tau in range(2):
+                extremal_boxes.append(non_local_boxes.utils.P_L(mu, nu, sigma, tau))
+                extremal_box_names.append("PL("+str(mu)+str(nu)+str(sigma)+str(tau)+")")
+extremal_boxes = torch.stack(extremal_boxes, dim=2)   # 4x4x24
+
+
+
+#
+#   Multiplication tables
+#
+
+def products(W, Boxes):
+    # W is a 32xc matrix, Boxes is a 4x4xk tensor
+    # All the products Boxes_i x_W Boxes_j, for all the wirings, in a single call to R
+    k, c = Boxes.shape[2], W.shape[1]
+    P = Boxes[:, :, torch.arange(k).repeat_interleave(k)].repeat(1, 1, c)   # columns (wiring, i, j)
+    Q = Boxes[:, :, torch.arange(k).repeat(k)].repeat(1, 1, c)
+    with torch.no_grad():
+        T = non_local_boxes.utils.tensor_to_matrix(non_local_boxes.evaluate.R(W.repeat_interleave(k*k, dim=1), P, Q))
+    return torch.permute(torch.reshape(T, (4, 4, c, k, k)), (0, 1, 3, 4, 2))
+    # the output is a 4x4xkxkxc tensor: output[:, :, i, j, w] is the product Boxes_i x_W Boxes_j for the wiring w
+
+
+def convex_decomposition(B, P, tolerance=1e-9):
+    # B is a 16xk numpy array (the boxes), P is a 16xn numpy array
+    # Linear program: minimize |B t - p| (L1 norm) with t >= 0 and sum t = 1 (exactly), with variables t, u, v
+    # where B t + u - v = p. The n columns are solved in a single program, whose constraint matrix is block
+    # diagonal. The dual simplex returns a vertex: at most 17 boxes have a non-zero coefficient in each column.
+    k, n = B.shape[1], P.shape[1]
+    block = scipy.sparse.bmat([[B, scipy.sparse.eye(16), -scipy.sparse.eye(16)], [numpy.ones((1, k)), None, None]])
+    A = scipy.sparse.kron(scipy.sparse.eye(n), block, format="csr")
+    cost = numpy.tile(numpy.concatenate((numpy.zeros(k), numpy.ones(32))), n)
+    result = scipy.optimize.linprog(cost, A_eq=A, b_eq=numpy.concatenate((P, numpy.ones((1, n)))).T.flatten(), bounds=(0, None), method="highs-ds")
+    if not result.success:
+        if n == 1:
+            return numpy.full((k, 1), numpy.nan)
+        return numpy.concatenate([convex_decomposition(B, P[:, j:j+1], tolerance) for j in range(n)], axis=1)
+    x = numpy.reshape(result.x, (n, k+32))
+    T = x[:, :k].T.copy()
+    T[:, numpy.sum(x[:, k:], axis=1) > tolerance] = numpy.nan
+    return T
+    # the output is a kxn numpy array: the coefficients of each column (nan if the program failed, or if the column
+    # is not a convex combination of the boxes, up to tolerance)
+
+
+def decompose(P, Boxes, simplex=None, decimals=12, columns_per_program=1024):
+    # P is a 4x4xn tensor, Boxes is a 4x4xk tensor
+    # Finds coefficients t with sum t = 1 such that P = sum_j t_j Boxes_j (as find_coeff in the notebook).
+    # - If not simplex, t is the least-squares solution with the smallest norm (the pseudo-inverse is computed
+    #   once for all the columns): it is the unique exact solution when P is in the affine span of the boxes
+    #   and the boxes are affinely independent (t may have negative entries, as with do_a_projection=False).
+    # - If simplex, t >= 0: the columns equal up to decimals are solved once, a column equal to one of the boxes
+    #   is this box, and the other ones are solved by convex_decomposition, columns_per_program at a time (t is
+    #   nan if P is not a convex combination of the boxes).
+    # By default, simplex is True if and only if the boxes are affinely dependent (for example, the 24 extremal
+    # boxes of NS only span a space of dimension 8), since then the decomposition is not unique.
+    B = torch.reshape(Boxes, (16, -1)).double()
+    P = torch.reshape(P, (16, -1)).double()
+    A = torch.cat((B, torch.ones(1, B.shape[1], dtype=torch.float64)))
+    if simplex is None:
+        simplex = bool(torch.linalg.matrix_rank(A) < B.shape[1])
+    if simplex:
+        columns, inverse = torch.unique(torch.round(P, decimals=decimals), dim=1, return_inverse=True)
+        equal = torch.all(torch.abs(columns[:, :, None] - B[:, None, :]) <= 10**-decimals, dim=0)   # equal[i, j]: the column i is the box j
+        found = equal.any(dim=1)
+        T = torch.zeros(B.shape[1], columns.shape[1], dtype=torch.float64)
+        T[torch.argmax(equal[found].int(), dim=1), torch.nonzero(found).squeeze(1)] = 1.
+        left = torch.nonzero(~found).squeeze(1)
+        for start in range(0, left.shape[0], columns_per_program):
+            indices = left[start:start+columns_per_program]
+            T[:, indices] = torch.tensor(convex_decomposition(B.numpy(), columns[:, indices].numpy()))
+        T = T[:, inverse]
+    else:
+        T = torch.matmul(torch.linalg.pinv(A), torch.cat((P, torch.ones(1, P.shape[1], dtype=torch.float64))))
+    errors = torch.sum(torch.abs(torch.matmul(B, T) - P), dim=0) + torch.abs(torch.sum(T, dim=0) - 1)
+    return T, errors
+    # the output is a kxn tensor of coefficients (in double precision), and a tensor with n entries: the L1 error
+    # |sum_j t_j Boxes_j - P| (the loss of the notebook) + |sum_j t_j - 1| (nan if t is nan)
+
+
+def multiplication_table(W, Boxes=extremal_boxes, simplex=None):
+    # W is a 32xc matrix, Boxes is a 4x4xk tensor (by default, the 24 extremal boxes of NS), simplex is as in decompose
+    k, c = Boxes.shape[2], W.shape[1]
+    P = products(W, Boxes)
+    T, errors = decompose(torch.reshape(P, (4, 4, -1)), Boxes, simplex)
+    return torch.permute(torch.reshape(T, (k, k, k, c)), (1, 2, 0, 3)), torch.reshape(errors, (k, k, c))
+    # the output is a kxkxkxc tensor: output[i, j, :, w] are the coefficients of Boxes_i x_W Boxes_j on the boxes,
+    # for the wiring w, and a kxkxc tensor of the errors of the decompositions
+
+
+def combination_string(coefficients, names, decimals=2):
+    # coefficients is a tensor with k entries, names is a list of k strings
+    terms = []
+    for value, name in zip(torch.round(coefficients, decimals=decimals).tolist(), names):
+        if value != 0:
+            terms.append(name if value == 1 else str(value)+"·"+name)
+    return " + ".join(terms)
+    # the output is a string, as written by `write_combinaison` in the notebook
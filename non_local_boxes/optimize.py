@@ -0,0 +1,207 @@
+import torch
+import non_local_boxes.accumulator
+import non_local_boxes.evaluate
+import non_local_boxes.search
+import non_local_boxes.utils
+
+
+#
+#   Line search with resets (Algorithm 3)
+#
+
+# We maximize phi_flat(W, P, Q) over the m columns of W at the same time. Each iteration is a gradient step
+# whose size is tuned column by column (line search). Every K_reset iterations, only the proportion
+# j*chi of best columns is kept (j = 0, 1, ..., 1/chi - 1) and the other ones are reset to random wirings.
+# The columns are independent, so they are handled chunk_size at a time: it is much faster than a single
+# pass over 10^6 columns, whose intermediate tensors do not fit in the cache.
+# Several boxes can be optimized at once: if P or Q is a 4x4xB tensor, there are m columns for each of the
+# B boxes (the columns b*m, ..., b*m + m-1 are for the box b), and the resets are done box by box.
+
+def box_columns(P, start, stop):  # P is a 4x4 matrix, or a 4x4xn tensor (one box per column)
+    return P if P.dim() == 2 else P[:, :, start:stop]
+
+
+def phi_flat_in_chunks(W, P, Q, chunk_size=2**14):
+    # W is a 32xm matrix, P and Q are 4x4 matrices (or 4x4xm tensors)
+    with torch.no_grad():
+        return torch.cat([non_local_boxes.evaluate.phi_flat(W[:, start:start+chunk_size], box_columns(P, start, start+chunk_size), box_columns(Q, start, start+chunk_size)) for start in range(0, W.shape[1], chunk_size)])
+    # the output is a tensor with m entries
+
+
+def select_best_columns(W, P, Q, k, chunk_size=2**14, nb_boxes=1):
+    # W is a 32x(nb_boxes*m) matrix, P and Q are 4x4 matrices (or 4x4x(nb_boxes*m) tensors)
+    # For each box, the k best columns of W are put (in decreasing order) in its first columns of a new
+    # random wiring
+    W_new = non_local_boxes.utils.random_wiring(W.shape[1]).detach()
+    if k > 0:
+        m = W.shape[1] // nb_boxes
+        best = torch.topk(torch.reshape(phi_flat_in_chunks(W, P, Q, chunk_size), (nb_boxes, m)), k).indices
+        best = best + m*torch.arange(nb_boxes).unsqueeze(1)
+        W_new.view(32, nb_boxes, m)[:, :, :k] = W.detach()[:, best]
+    return W_new
+    # the output is a 32x(nb_boxes*m) matrix
+
+
+class LineSearchWithResets:
+    # step_size is the initial step of the line search, multiplied by step_decrease when the gain decreases
+    # and by step_increase otherwise, LS_iterations times per gradient step. The last round of resets does
+    # final_factor*K_reset gradient steps instead of K_reset.
+
+    def __init__(self, LS_iterations=10, K_reset=5, chi=0.3, step_size=0.01, step_decrease=0.8, step_increase=1.3, final_factor=10, chunk_size=2**14):
+        self.LS_iterations = LS_iterations
+        self.K_reset = K_reset
+        self.chi = chi
+        self.step_size = step_size
+        self.step_decrease = step_decrease
+        self.step_increase = step_increase
+        self.final_factor = final_factor
+        self.chunk_size = chunk_size
+
+    def value_and_grad(self, W, P, Q):
+        # W is a 32xm matrix
+        return non_local_boxes.evaluate.phi_and_grad(W, P, Q)
+
+    def step(self, W, P, Q):
+        # One gradient step with line search, for all the columns of W at once
+        # phi_flat(W + alpha*gradient) is a polynomial in alpha (see `evaluate.phi_along_line`): the trial
+        # steps of the line search only evaluate this polynomial, and the value at W comes with the gradient.
+        Gains, gradient = self.value_and_grad(W, P, Q)
+        with torch.no_grad():
+            coefficients = non_local_boxes.evaluate.phi_along_line(W, gradient, P, Q)
+            alpha = torch.full((W.shape[1],), self.step_size)
+            Gains_futur = non_local_boxes.evaluate.polynomial_value(coefficients, alpha)
+            for _ in range(self.LS_iterations):
+                alpha = torch.where(Gains > Gains_futur, self.step_decrease*alpha, self.step_increase*alpha)
+                Gains = torch.maximum(Gains, Gains_futur)
+                Gains_futur = non_local_boxes.evaluate.polynomial_value(coefficients, alpha)
+            return non_local_boxes.utils.projected_step(W, alpha, gradient)
+
+    def run(self, P, Q, m):
+        # P and Q are 4x4 matrices (or 4x4xB tensors: B boxes), m is the number of columns (for each box)
+        nb_boxes = P.shape[2] if P.dim() == 3 else (Q.shape[2] if Q.dim() == 3 else 1)
+        if P.dim() == 3:
+            P = torch.repeat_interleave(P, m, dim=2)
+        if Q.dim() == 3:
+            Q = torch.repeat_interleave(Q, m, dim=2)
+        W = torch.zeros(32, nb_boxes*m)
+        nb_resets = int(1/self.chi)
+        for j in range(nb_resets):
+            W = select_best_columns(W, P, Q, min(m, int(j*m*self.chi)), self.chunk_size, nb_boxes)
+            nb_steps = self.final_factor*self.K_reset if j == nb_resets-1 else self.K_reset
+            for start in range(0, nb_boxes*m, self.chunk_size):
+                stop = start+self.chunk_size
+                for _ in range(nb_steps):
+                    W[:, start:stop] = self.step(W[:, start:stop], box_columns(P, start, stop), box_columns(Q, start, stop))
+        return W
+        # the output is a 32x(B*m) matrix
+
+
+def line_search_with_resets(P, Q, LS_iterations, K_reset, chi, m=None):
+    # P and Q are 4x4 matrices, m is the number of columns (by default, `evaluate.nb_columns`)
+    if m is None:
+        m = non_local_boxes.evaluate.nb_columns
+    return LineSearchWithResets(LS_iterations, K_reset, chi).run(P, Q, m)
+    # the output is a 32xm matrix
+
+
+
+#
+#   Exact block-coordinate ascent
+#
+
+# phi_flat is affine in each of the blocks f1, g1, f2, g2, f3, g3 of W when the other ones are fixed (see
+# `evaluate.phi_and_grad`), so its maximum over a block is reached at a vertex given by the sign of the
+# gradient. In the feasible set, f1(x,.) must be constant when f2(x,.) is not (and conversely, and similarly
+# for g1, g2): then the best constant is given by the sign of the sum of the two partial derivatives. The
+# coordinates with a zero derivative are rounded: since phi_flat is affine in the block, its value does not
+# change, and after a sweep W is a deterministic wiring.
+# function_blocks lists (first coordinate, last coordinate + 1, shift to the coupled block, or None).
+function_blocks = [(0, 4, 8), (4, 8, 8), (8, 12, -8), (12, 16, -8), (16, 24, None), (24, 32, None)]
+
+
+def maximize_block(W, gradient, block):
+    # W and gradient are 32xm matrices, gradient is the gradient of phi_flat at W
+    # The coordinates with a zero derivative are rounded (the value of phi_flat does not change)
+    first, stop, shift = block
+    W = W.clone()
+    best = torch.where(gradient[first:stop] > 0, 1., torch.where(gradient[first:stop] < 0, 0., torch.round(W[first:stop])))
+    if shift is not None:
+        for i in range(first, stop, 2):
+            derivative = gradient[i] + gradient[i+1]
+            constant = torch.where(derivative > 0, 1., torch.where(derivative < 0, 0., torch.round(W[i])))
+            free = W[i+shift] == W[i+shift+1]   # the coupled function is constant
+            best[i-first] = torch.where(free, best[i-first], constant)
+            best[i-first+1] = torch.where(free, best[i-first+1], constant)
+    W[first:stop] = best
+    return W
+    # the output is a 32xm matrix
+
+
+def coordinate_ascent_sweep(W, P, Q):
+    # W is a 32xm matrix, P and Q are 4x4 matrices
+    # Maximizes phi_flat exactly over f1, g1, f2, g2, f3 and g3, one after the other: phi_flat never decreases
+    W = non_local_boxes.utils.projected_wiring(W)
+    for block in function_blocks:
+        _, gradient = non_local_boxes.evaluate.phi_and_grad(W, P, Q)
+        W = maximize_block(W, gradient, block)
+    return W
+    # the output is a 32xm matrix
+
+
+class CoordinateAscentWithResets(LineSearchWithResets):
+    # Same resets as LineSearchWithResets, but each step is a coordinate_ascent_sweep: a few sweeps are enough
+    # to reach a vertex of the feasible set (a deterministic wiring) where no block can be improved.
+
+    def __init__(self, K_reset=3, chi=0.3, final_factor=3, chunk_size=2**14):
+        super().__init__(K_reset=K_reset, chi=chi, final_factor=final_factor, chunk_size=chunk_size)
+
+    def step(self, W, P, Q):
+        return coordinate_ascent_sweep(W, P, Q)
+
+
+
+#
+#   Multi-start driver
+#
+
+# The random starts are split into shards of shard_size columns. The shard number s is optimized on its
+# own, after torch.manual_seed(seed + s): its result does not depend on the process where it runs, and the
+# shards are merged in their order, so the output does not depend on nb_workers. Note that the resets of the
+# optimizer keep the best columns of the shard, not of all the columns.
+
+def run_shard(optimizer, P, Q, shard, shard_size, seed, k, bins):
+    torch.manual_seed(seed + shard)
+    W = optimizer.run(P, Q, shard_size)
+    accumulator = non_local_boxes.accumulator.Accumulator(bins, k)
+    with torch.no_grad():
+        for start in range(0, shard_size, optimizer.chunk_size):
+            chunk = W[:, start:start+optimizer.chunk_size]
+            accumulator.update(non_local_boxes.evaluate.phi_flat(chunk, P, Q), chunk)
+    return accumulator
+
+
+def run_shard_in_worker(args):
+    return run_shard(*args)
+
+
+def multi_start(optimizer, P, Q, nb_columns, shard_size=2**14, k=10, bins=100, seed=0, nb_workers=1, threads_per_worker=1):
+    # optimizer is a LineSearchWithResets (or CoordinateAscentWithResets), P and Q are 4x4 matrices
+    # Optimizes nb_columns random starts and keeps the k best wirings and the histogram of all the final values
+    jobs = ((optimizer, P, Q, shard, min(shard_size, nb_columns - start), seed, k, bins) for shard, start in enumerate(range(0, nb_columns, shard_size)))
+    if nb_workers > 1:
+        pool = torch.multiprocessing.get_context("spawn").Pool(nb_workers, initializer=non_local_boxes.search.init_worker, initargs=(threads_per_worker,))
+        results = pool.imap(run_shard_in_worker, jobs)   # in the order of the shards
+    else:
+        pool = None
+        results = map(run_shard_in_worker, jobs)
+
+    accumulator = non_local_boxes.accumulator.Accumulator(bins, k)
+    try:
+        for shard_accumulator in results:
+            accumulator.merge(shard_accumulator)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return accumulator
+    # the output is an `accumulator.Accumulator`: the histogram and the statistics of the nb_columns final
+    # values, with the k best values and their wirings
@@ -0,0 +1,49 @@
+import torch
+import non_local_boxes.evaluate
+import non_local_boxes.utils
+
+
+#
+#   Orbits of a box under a wiring
+#
+
+# The orbit of depth k of P is the set of all the products of k copies of P (for all parenthesizations),
+# i.e. all the products Q1 x_W Q2 with Q1 in the orbit of depth l and Q2 in the orbit of depth k-l.
+# There are Catalan(k-1) parenthesizations, but many of them give the same box: the boxes of each depth
+# are rounded to a multiple of `tolerance` and only one box per rounded value is kept.
+
+def unique_boxes(Q, tolerance):  # Q is a 4x4xm tensor
+    keys = torch.round(torch.reshape(Q, (16, -1)) / tolerance).to(torch.int64)
+    keys, inverse = torch.unique(keys, dim=1, return_inverse=True)
+    first = torch.full((keys.shape[1],), Q.shape[2], dtype=torch.int64)
+    first = first.scatter_reduce(0, inverse, torch.arange(Q.shape[2]), reduce="amin")
+    return Q[:, :, first]
+    # the output is a 4x4xm' tensor, with one box per rounded value (the first one, in the order of Q)
+
+
+def pairwise_products(W, Q1, Q2, tolerance, chunk_size):
+    # W is a 32x1 matrix, Q1 is a 4x4xm1 tensor and Q2 is a 4x4xm2 tensor
+    # Computes the m1*m2 products Q1[:,:,i] x_W Q2[:,:,j], chunk_size products at a time
+    m1, m2 = Q1.shape[2], Q2.shape[2]
+    for start in range(0, m1*m2, chunk_size):
+        index = torch.arange(start, min(start+chunk_size, m1*m2))
+        products = non_local_boxes.evaluate.R(W.expand(32, index.shape[0]), Q1[:, :, index // m2], Q2[:, :, index % m2])
+        yield unique_boxes(non_local_boxes.utils.tensor_to_matrix(products), tolerance)
+
+
+def orbit_levels(W, P, max_depth, tolerance=1e-6, chunk_size=2**14):
+    # W is a 32x1 matrix, P is a 4x4 matrix
+    # Yields the orbits of depth 1, 2, ..., max_depth of P, one at a time, as 2x2x2x2xm tensors
+    Orbits = [torch.unsqueeze(P, 2)]   # Orbits[k] is the orbit of depth k+1, as a 4x4xm tensor
+    yield non_local_boxes.utils.matrix_to_tensor(Orbits[0])
+    with torch.no_grad():
+        for k in range(1, max_depth):
+            level = [Q for l in range(k) for Q in pairwise_products(W, Orbits[l], Orbits[k-1-l], tolerance, chunk_size)]
+            Orbits.append(unique_boxes(torch.cat(level, dim=2), tolerance))
+            yield non_local_boxes.utils.matrix_to_tensor(Orbits[k])
+
+
+def orbit(W, P, max_depth, tolerance=1e-6, chunk_size=2**14):
+    # W is a 32x1 matrix, P is a 4x4 matrix
+    return list(orbit_levels(W, P, max_depth, tolerance, chunk_size))
+    # the output is a list of max_depth tensors of size 2x2x2x2xm
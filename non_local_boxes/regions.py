@@ -0,0 +1,202 @@
+import math
+import torch
+import non_local_boxes.utils
+
+
+#
+#   Triangles of boxes
+#
+
+# The boxes of a triangle P1, P2, P3 are the combinations c1*P1 + c2*P2 + c3*P3 with c1 + c2 + c3 = 1: all the
+# grids of boxes of the scans (`collapse.collapse_map`, `collapse.screen_wirings`, `scan.collapse_scan`,
+# `scan.frontier_scan`) are built by `Triangle.combinations`. As in the notebooks, the boxes are also drawn at
+# the point (winning probability at a game, winning probability at CHSH). A game is a tensor with 16 entries,
+# in the same layout as `utils.CHSH_flat`. The map (c1, c2, c3) -> (game value, CHSH value, 1) is linear: it
+# is inverted once per triangle (in double precision), and then the boxes go to the plane and back with one
+# matmul.
+
+def grid_coefficients(grid_size):
+    # Barycentric coordinates of the points i/grid_size, j/grid_size with i+j <= grid_size
+    i, j = torch.meshgrid(torch.arange(grid_size+1), torch.arange(grid_size+1), indexing="ij")
+    inside = i+j <= grid_size
+    alpha, beta = i[inside]/grid_size, j[inside]/grid_size
+    return torch.stack((alpha, beta, 1-alpha-beta))
+    # the output is a 3xm tensor, with m = (grid_size+1)(grid_size+2)/2
+
+
+class Triangle:
+
+    def __init__(self, P1, P2, P3, game=non_local_boxes.utils.CHSH_prime_flat, inverse=None):
+        # P1, P2, P3 are 4x4 matrices, game is a tensor with 16 entries, inverse is the inverse of
+        # self.coordinates (computed by barycentric_map when it is first needed, if not given)
+        self.P1, self.P2, self.P3, self.game = P1, P2, P3, game
+        self.corners = torch.stack([non_local_boxes.utils.matrix_to_tensor(P).flatten() for P in (P1, P2, P3)], dim=1).double()   # 16x3
+        self.games = torch.stack((game, non_local_boxes.utils.CHSH_flat)).double()   # 2x16
+        self.coordinates = torch.cat((torch.matmul(self.games, self.corners), torch.ones(1, 3, dtype=torch.float64)))   # columns (game value, CHSH value, 1) of the corners
+        self.inverse = inverse
+
+    def combinations(self, coefficients):  # coefficients is a 3xn tensor
+        c = coefficients.to(self.P1.dtype)
+        return c[0]*torch.unsqueeze(self.P1, 2) + c[1]*torch.unsqueeze(self.P2, 2) + c[2]*torch.unsqueeze(self.P3, 2)
+        # the output is the 4x4xn tensor of the boxes c[0]*P1 + c[1]*P2 + c[2]*P3 (in the precision of P1)
+
+    def grid(self, grid_size):
+        return self.combinations(grid_coefficients(grid_size))
+        # the output is the 4x4xm tensor of the boxes at the points of grid_coefficients(grid_size)
+
+    def segment(self, grid_size):
+        alpha = torch.arange(grid_size+1)/grid_size
+        return self.combinations(torch.stack((alpha, 1-alpha, torch.zeros_like(alpha))))
+        # the output is the 4x4x(grid_size+1) tensor of the boxes alpha*P1 + (1-alpha)*P2 of the side P1 -- P2,
+        # for alpha = 0, 1/grid_size, ..., 1
+
+    def mixtures(self, alpha, gamma):  # alpha and gamma are numbers or tensors with n entries
+        alpha, gamma = torch.broadcast_tensors(torch.atleast_1d(torch.as_tensor(alpha, dtype=torch.float64)), torch.atleast_1d(torch.as_tensor(gamma, dtype=torch.float64)))
+        return self.combinations(torch.stack((alpha, 1-alpha-gamma, gamma)))
+        # the output is the 4x4xn tensor of the boxes alpha*P1 + (1-alpha-gamma)*P2 + gamma*P3 (as in the scans)
+
+    def barycentric_map(self):
+        if self.inverse is None:
+            if torch.linalg.det(self.coordinates) == 0:
+                raise ValueError("The three boxes are aligned in the plane (game, CHSH).")
+            self.inverse = torch.linalg.inv(self.coordinates)
+        return self.inverse
+        # the output is a 3x3 matrix: (c1, c2, c3) = output @ (game value, CHSH value, 1)
+
+    def plane_coordinates(self, P):  # P is a 2x2x2x2xn tensor (any boxes, not only in the triangle)
+        return torch.matmul(self.games, torch.reshape(P, (16, -1)).double())
+        # the output is a 2xn tensor: the game values and the CHSH values
+
+    def barycentric(self, G, C):  # G and C are tensors with n entries
+        return torch.matmul(self.barycentric_map(), torch.stack((G.double(), C.double(), torch.ones_like(G, dtype=torch.float64))))
+        # the output is a 3xn tensor: the coefficients of P1, P2, P3
+
+    def boxes(self, G, C):  # G and C are tensors with n entries
+        return torch.reshape(torch.matmul(self.corners, self.barycentric(G, C)), (2, 2, 2, 2, -1))
+        # the output is the 2x2x2x2xn tensor of the boxes at the points (G, C) of the plane (in double precision)
+
+    def is_in_Q(self, G, C):  # G and C are tensors with n entries
+        return is_in_Q_flat(self.boxes(G, C))
+        # the output is a boolean tensor with n entries
+
+    def is_in_BBP23(self, G, C):  # G and C are tensors with n entries
+        return is_in_BBP23_flat(self.boxes(G, C))
+        # the output is a boolean tensor with n entries
+
+    def quantum_boundary(self, G, low=None, iterations=30):
+        # G is a tensor with n entries
+        # The boundary is searched between low (by default, the lowest CHSH value of P2 and P3) and Tsirelson's bound
+        if low is None:
+            low = float(torch.min(self.coordinates[1, 1:]))
+        return boundary(self.is_in_Q, G.double(), low, Tsirelson_value, True, iterations)
+        # the output is a tensor with n entries: the largest CHSH value of a quantum box (nan if none)
+
+    def BBP23_boundary(self, G, low, high=non_local_boxes.utils.BBLMTU_value, iterations=30):
+        # G is a tensor with n entries, low is a number or a tensor with n entries (the notebooks start from the
+        # line (0.5, 0.9) -- (0.75, 0.75))
+        return boundary(self.is_in_BBP23, G.double(), low, high, False, iterations)
+        # the output is a tensor with n entries: the smallest CHSH value of a box collapsing by [BBP23] (nan if none)
+
+
+def coordinate_matrix(P1, P2, P3, game):
+    # P1, P2, P3 are 4x4 matrices, game is a tensor with 16 entries
+    return Triangle(P1, P2, P3, game).coordinates
+    # the output is the 3x3 matrix of the columns (game value, CHSH value, 1) of the three corners
+
+
+def barycentric_map(P1, P2, P3, game):
+    # P1, P2, P3 are 4x4 matrices, game is a tensor with 16 entries
+    return Triangle(P1, P2, P3, game).barycentric_map()
+    # the output is a 3x3 matrix: (alpha, beta, gamma) = output @ (game value, CHSH value, 1)
+
+
+def boxes_at(P1, P2, P3, inverse, G, C):
+    # P1, P2, P3 are 4x4 matrices, inverse is barycentric_map(P1, P2, P3, game), G and C are tensors with n entries
+    return Triangle(P1, P2, P3, inverse=inverse).boxes(G, C)
+    # the output is the 2x2x2x2xn tensor of the boxes at the points (G, C) of the plane (in double precision)
+
+
+
+#
+#   Quantum set and [BBP23]
+#
+
+Tsirelson_value = (2+math.sqrt(2))/4
+
+
+def correlators(P):  # P is a 2x2x2x2xn tensor
+    return P[0, 0] + P[1, 1] - P[0, 1] - P[1, 0]
+    # the output is a 2x2xn tensor: the correlator E(x,y) of each box
+
+
+def is_in_Q_flat(P):  # P is a 2x2x2x2xn tensor
+    # Test of the article (arcsin of the correlators), which characterizes the quantum boxes among the boxes of
+    # the triangles of the notebooks
+    E = torch.clamp(correlators(P), -1., 1.)
+    return torch.arcsin(E[0, 0]) + torch.arcsin(E[0, 1]) + torch.arcsin(E[1, 0]) - torch.arcsin(E[1, 1]) <= math.pi
+    # the output is a boolean tensor with n entries
+
+
+def eta(P):  # P is a 2x2x2x2xn tensor
+    return torch.stack([torch.stack([2*P[0, x*y, x, y] + 2*P[1, (1+x*y) % 2, x, y] - 1 for y in range(2)]) for x in range(2)])
+    # the output is a 2x2xn tensor
+
+
+def is_in_BBP23_flat(P):  # P is a 2x2x2x2xn tensor
+    e = eta(P)
+    A = (e[0, 0] + e[0, 1] + e[1, 0] + e[1, 1])**2
+    B = 2*e[0, 0]**2 + 4*e[1, 0]*e[0, 1] + 2*e[1, 1]**2
+    return A + B > 16
+    # the output is a boolean tensor with n entries: the box is collapsing according to [BBP23]
+
+
+def is_in_Q(G, C, P1, P2, P3, game, inverse=None):
+    # G and C are tensors with n entries (points of the plane), P1, P2, P3 are 4x4 matrices, game is a tensor with
+    # 16 entries, inverse is barycentric_map(P1, P2, P3, game) (computed if not given)
+    return Triangle(P1, P2, P3, game, inverse).is_in_Q(G, C)
+    # the output is a boolean tensor with n entries
+
+
+def is_in_BBP23(G, C, P1, P2, P3, game, inverse=None):
+    # same as is_in_Q
+    return Triangle(P1, P2, P3, game, inverse).is_in_BBP23(G, C)
+    # the output is a boolean tensor with n entries
+
+
+
+#
+#   Boundary curves
+#
+
+# For each value G of the game, the boundary of a region is searched on the vertical segment [low, high] by
+# bisection, for all the values of G at once. The quantum set is below its boundary (as in the notebooks,
+# which go down from Tsirelson's bound), and the [BBP23] region is above its boundary.
+
+def boundary(test, G, low, high, below, iterations=30):
+    # test is a function (G, C) -> boolean tensor, G is a tensor with n entries, low and high are numbers or
+    # tensors with n entries, below is True if the region is below the boundary (and False if it is above)
+    low, high = torch.broadcast_to(torch.as_tensor(low, dtype=torch.float64), G.shape).clone(), torch.broadcast_to(torch.as_tensor(high, dtype=torch.float64), G.shape).clone()
+    found = test(G, low) if below else test(G, high)
+    inside = test(G, high) if below else test(G, low)
+    for _ in range(iterations):
+        middle = (low + high)/2
+        in_region = test(G, middle)
+        low, high = torch.where(in_region == below, middle, low), torch.where(in_region == below, high, middle)
+    C = torch.where(inside, high if below else low, low if below else high)
+    return torch.where(found, C, float("nan"))
+    # the output is a tensor with n entries: the value of C on the boundary (nan if the segment does not meet
+    # the region)
+
+
+def quantum_boundary(P1, P2, P3, game, G, low=None, iterations=30):
+    # P1, P2, P3 are 4x4 matrices, game is a tensor with 16 entries, G is a tensor with n entries (see
+    # Triangle.quantum_boundary)
+    return Triangle(P1, P2, P3, game).quantum_boundary(G, low, iterations)
+    # the output is a tensor with n entries: the largest CHSH value of a quantum box (nan if none)
+
+
+def BBP23_boundary(P1, P2, P3, game, G, low, high=non_local_boxes.utils.BBLMTU_value, iterations=30):
+    # P1, P2, P3 are 4x4 matrices, game is a tensor with 16 entries, G is a tensor with n entries (see
+    # Triangle.BBP23_boundary)
+    return Triangle(P1, P2, P3, game).BBP23_boundary(G, low, high, iterations)
+    # the output is a tensor with n entries: the smallest CHSH value of a box collapsing by [BBP23] (nan if none)
@@ -0,0 +1,85 @@
+import datetime
+import json
+import torch
+import non_local_boxes.utils
+
+
+#
+#   Registry of collapsing wirings
+#
+
+class WiringRegistry:
+    # The wirings are stored as 32-bit keys (see `utils.wiring_to_key`) in a dictionary key -> metadata.
+    # If `symmetries` is not None, the keys are the canonical keys of `utils.canonical_keys`, so that a
+    # wiring is found as soon as an equivalent wiring is registered.
+
+    def __init__(self, symmetries=None):
+        self.symmetries = None if symmetries is None else tuple(symmetries)
+        self.entries = {}
+
+    def keys_of(self, W):  # W is a 32xn tensor with 0/1 entries
+        keys = non_local_boxes.utils.wiring_to_key(W)
+        if self.symmetries is not None:
+            keys = non_local_boxes.utils.canonical_keys(keys, self.symmetries)[0]
+        return keys
+
+    def key_of(self, W):  # W is a list (with 32 entries), or a 32x1 tensor
+        return int(self.keys_of(torch.reshape(torch.as_tensor(W, dtype=torch.float32), (32, 1)))[0])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, W):  # W is a list (with 32 entries), or a 32x1 tensor
+        return self.key_of(W) in self.entries
+
+    def lookup(self, W):  # W is a list (with 32 entries), or a 32x1 tensor
+        return self.entries.get(self.key_of(W))
+        # the output is the metadata of the registered wiring, or None
+
+    def contains(self, W):  # W is a 32xn tensor with 0/1 entries
+        known = torch.tensor(list(self.entries), dtype=torch.int64)
+        return torch.isin(self.keys_of(W), known)
+        # the output is a boolean tensor with n entries
+
+    def add(self, W, triangle=None, threshold=None, date="today", number=None, **metadata):
+        # W is a list (with 32 entries), or a 32x1 tensor, number is the number of the wiring (by default, the
+        # largest registered number + 1)
+        # Returns False (and changes nothing) if the wiring is already registered
+        key = self.key_of(W)
+        if key in self.entries:
+            return False
+        if date == "today":
+            date = datetime.date.today().isoformat()
+        if number is None:
+            number = max((entry["number"] for entry in self.entries.values()), default=0) + 1
+        self.entries[key] = dict(number=number, triangle=triangle, threshold=threshold, date=date, **metadata)
+        return True
+
+    def wirings(self):
+        return non_local_boxes.utils.key_to_wiring(torch.tensor(list(self.entries), dtype=torch.int64))
+        # the output is a 32xn tensor, in the order of registration
+
+    def save(self, path):
+        data = {"symmetries": self.symmetries, "wirings": [dict(key=key, **self.entries[key]) for key in self.entries]}
+        with open(path, "w") as file:
+            json.dump(data, file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            data = json.load(file)
+        registry = cls(data["symmetries"])
+        for entry in data["wirings"]:
+            key = entry.pop("key")
+            registry.entries[key] = entry
+        return registry
+
+
+def known_collapsing_registry(symmetries=None):
+    # Registry containing the wirings of `utils.known_collapsing_W`, in the same order: the number of a wiring
+    # is its position in the list (as in the "i-th / len" message of `Test_Wiring`), even if a duplicated
+    # wiring is skipped
+    registry = WiringRegistry(symmetries)
+    for i, W in enumerate(non_local_boxes.utils.known_collapsing_W):
+        registry.add(W, source="utils.known_collapsing_W", date=None, number=i+1)
+    return registry
@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import torch
+import non_local_boxes.collapse
+import non_local_boxes.evaluate
+import non_local_boxes.optimize
+import non_local_boxes.regions
+import non_local_boxes.utils
+
+
+#
+#   Resumable scans of the collapsing boxes (as in `draw_collapsing_boxes`)
+#
+
+# Each tested point (alpha, gamma) of the triangle alpha*P1 + (1-alpha-gamma)*P2 + gamma*P3 is written in
+# a SQLite file as soon as it is decided (one row per method and point, never modified). If the scan is
+# interrupted, the same call with the same file walks again through the decided points without testing them.
+
+class ScanStore:
+
+    def __init__(self, path, parameters):
+        # parameters is a dictionary (JSON-serializable) describing the scan: a store can only be reused
+        # for the same parameters
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS parameters (value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS points (method TEXT, alpha REAL, gamma REAL, collapsed INTEGER, depth INTEGER, chsh REAL, wiring TEXT, PRIMARY KEY (method, alpha, gamma))")
+        stored = self.connection.execute("SELECT value FROM parameters").fetchone()
+        if stored is None:
+            self.connection.execute("INSERT INTO parameters VALUES (?)", (json.dumps(parameters),))
+            self.connection.commit()
+        elif json.loads(stored[0]) != json.loads(json.dumps(parameters)):
+            raise ValueError("The scan " + path + " was computed with other parameters.")
+
+    def get(self, method, alpha, gamma):
+        row = self.connection.execute("SELECT collapsed, depth, chsh, wiring FROM points WHERE method=? AND alpha=? AND gamma=?", (method, alpha, gamma)).fetchone()
+        if row is None:
+            return None
+        return bool(row[0]), row[1], row[2], None if row[3] is None else json.loads(row[3])
+        # the output is (collapsing or not, depth, CHSH value, wiring as a list or None)
+
+    def add(self, method, alpha, gamma, collapsed, depth, chsh, wiring=None):
+        self.connection.execute("INSERT INTO points VALUES (?, ?, ?, ?, ?, ?, ?)", (method, alpha, gamma, int(collapsed), depth, chsh, None if wiring is None else json.dumps(wiring)))
+        self.connection.commit()
+
+    def points(self, method):
+        return self.connection.execute("SELECT alpha, gamma, collapsed, depth, chsh, wiring FROM points WHERE method=? ORDER BY rowid", (method,)).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def collapse_scan(path, P1, P2, P3, max_power, precision, optimizer=None, m=1000, print_details=False):
+    # P1, P2, P3 are 4x4 matrices, optimizer is a `optimize.LineSearchWithResets` (see `collapse.is_in_here`)
+    # For each gamma = 0, 3/4*precision, ..., alpha increases by precision until the box is collapsing (with
+    # [BS09], then with Algorithm 4 for the points not found by [BS09]), and then gamma increases.
+    if optimizer is None:
+        optimizer = non_local_boxes.optimize.LineSearchWithResets(LS_iterations=20, K_reset=10, chi=0.1)
+    parameters = {"P1": P1.tolist(), "P2": P2.tolist(), "P3": P3.tolist(), "max_power": max_power, "precision": precision, "optimizer": type(optimizer).__name__, "optimizer_parameters": vars(optimizer), "m": m}
+    store = ScanStore(path, parameters)
+    y1 = float(non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(P1)))
+    y3 = float(non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(P3)))
+    alpha_max = 1-(1-non_local_boxes.collapse.BBLMTU_value)/(y1-y3)
+    triangle = non_local_boxes.regions.Triangle(P1, P2, P3)
+
+    lists = {}
+    try:
+        for method in ("BS09", "here"):
+            lists[method] = []
+            alpha, gamma = 0., 0.
+            while gamma < 0.5 and alpha < alpha_max:
+                alpha2, gamma2 = round(alpha, 4), round(gamma, 4)
+                if method == "here" and [alpha2, gamma2] in lists["BS09"]:
+                    gamma += precision*(3/4)
+                    continue
+                result = store.get(method, alpha2, gamma2)
+                if result is None:
+                    if print_details: print(method, alpha2, gamma2)
+                    P = triangle.mixtures(alpha2, gamma2)[:, :, 0]
+                    if method == "BS09":
+                        collapsed, depth, chsh = non_local_boxes.collapse.is_in_BS09(P, 2*max_power)
+                        wiring = None
+                    else:
+                        collapsed, depth, chsh, wiring = non_local_boxes.collapse.is_in_here(P, max_power, optimizer, m)
+                        wiring = wiring.tolist()
+                    store.add(method, alpha2, gamma2, collapsed, depth, chsh, wiring)
+                    result = (collapsed, depth, chsh, wiring)
+                if result[0]:
+                    lists[method].append([alpha2, gamma2])
+                    gamma += precision*(3/4)
+                else:
+                    alpha += precision
+    finally:
+        store.close()
+    return lists["BS09"], lists["here"]
+    # the output is List_BS09 and List_here of `draw_from_lists`: the first collapsing point of each row
+
+
+
+#
+#   Frontier of the collapsing region
+#
+
+# Along a slice gamma = constant, the boxes alpha*P1 + (1-alpha-gamma)*P2 + gamma*P3 are assumed to collapse
+# for all alpha above some frontier (as in collapse_scan, where the rest of the row is not tested). The
+# frontier is found by bisection on alpha, up to precision. The bracket starts from the frontier of the
+# previous slice, and grows by steps precision, 2*precision, 4*precision, ... until it contains the frontier.
+# Before running Algorithm 4 on a box, the last collapsing wiring is tried (see `collapse.collapse_depths`):
+# when the frontier is smooth, most of the boxes are decided by this wiring.
+
+def is_collapsing(P, max_power, optimizer, m, threshold, W=None):
+    # P is a 4x4 matrix, W is a vector of size 32 (or None)
+    if W is not None:
+        depth = non_local_boxes.collapse.collapse_depths(torch.unsqueeze(W, 1), torch.unsqueeze(P, 2), max_power, threshold)
+        if depth[0] >= 0:
+            return True, W
+    collapsed, _, _, wiring = non_local_boxes.collapse.is_in_here(P, max_power, optimizer, m, threshold)
+    return collapsed, wiring if collapsed else W
+    # the output is (collapsing or not, last collapsing wiring)
+
+
+def frontier_scan(P1, P2, P3, gammas, max_power, precision, optimizer=None, m=1000, threshold=non_local_boxes.collapse.BBLMTU_value, W=None, print_details=False):
+    # P1, P2, P3 are 4x4 matrices, gammas is a tensor with s entries, optimizer is a `optimize.LineSearchWithResets`
+    # (see `collapse.is_in_here`), W is a vector of size 32: a wiring to try first (optional)
+    if optimizer is None:
+        optimizer = non_local_boxes.optimize.LineSearchWithResets(LS_iterations=20, K_reset=10, chi=0.1)
+    y1, y2, y3 = (float(non_local_boxes.evaluate.h_flat(non_local_boxes.utils.matrix_to_tensor(P))) for P in (P1, P2, P3))
+    frontier, error = torch.full((gammas.shape[0],), float("nan")), torch.full((gammas.shape[0],), float("nan"))
+    wirings = torch.full((32, gammas.shape[0]), float("nan"))
+    triangle, previous = non_local_boxes.regions.Triangle(P1, P2, P3), None
+    for i, gamma in enumerate(gammas.tolist()):
+        # above alpha_max, the box wins CHSH above the threshold
+        alpha_max = min(1-gamma, (threshold - y2 - gamma*(y3-y2))/(y1-y2)) if y1 > y2 else 1-gamma
+        cache, found = {}, False   # found: a wiring collapsed a box of this slice
+        def test(alpha):
+            nonlocal W, found
+            if alpha not in cache:
+                if print_details: print(gamma, alpha)
+                cache[alpha], W = is_collapsing(triangle.mixtures(alpha, gamma)[:, :, 0], max_power, optimizer, m, threshold, W)
+                found = found or cache[alpha]
+            return cache[alpha]
+
+        if alpha_max == 1-gamma and not test(alpha_max):
+            continue   # no collapsing box on the slice
+        low, high = 0., alpha_max
+        if previous is not None and 0. < previous < alpha_max:
+            step = precision
+            if test(previous):
+                high = previous
+                while high - step > 0. and test(high - step):
+                    high, step = high - step, 2*step
+                low = max(0., high - step)
+            else:
+                low = previous
+                while low + step < alpha_max and not test(low + step):
+                    low, step = low + step, 2*step
+                high = min(alpha_max, low + step)
+        if low == 0. and test(0.):
+            high = 0.
+        while high - low > precision:
+            middle = (low + high)/2
+            if test(middle):
+                high = middle
+            else:
+                low = middle
+        frontier[i], error[i] = (low + high)/2, (high - low)/2
+        if found:
+            wirings[:, i] = W.detach()
+        previous = frontier[i].item()
+    return frontier, error, wirings
+    # the output is three tensors: for each gamma, the frontier alpha (nan if no box of the slice is collapsing),
+    # its error (the frontier is in [frontier - error, frontier + error]), and the last collapsing wiring found
+    # on the slice (a 32xs matrix, nan if none)
@@ -0,0 +1,123 @@
+import os
+import torch
+import non_local_boxes.evaluate
+import non_local_boxes.utils
+
+
+#
+#   Exhaustive search over the deterministic wirings
+#
+
+# A deterministic wiring is in the feasible set \mathcal{W} if, for each x, f1(x,.) does not depend on a2
+# or f2(x,.) does not depend on a1 (and similarly for g1, g2 and each y). These are the pairs of
+# coordinates compared in `utils.projected_wiring`: the other 0/1 vectors are not wirings and are skipped.
+# Moreover, the wirings that differ only by irrelevant coordinates give the same box products (see
+# `utils.reduce_wiring`), so we only enumerate the reduced ones. Each of the 4 blocks of `utils.wiring_blocks`
+# has 82 feasible and reduced states (out of the 12*16 feasible ones).
+
+def reduced_block_states():
+    states = []
+    for t in range(16):
+        for s in range(16):
+            if (s & 1) != (s >> 1) & 1 and (s >> 2) & 1 != (s >> 3) & 1:  # f1 and f2 both depend on the previous output
+                continue
+            if non_local_boxes.utils.block_reduction[t, s] == s:
+                states.append((t, s))
+    return states
+    # the output is the list of the 82 feasible and reduced states (t, s) of a block
+
+
+def reduced_block_keys(states):
+    keys = torch.zeros((4, len(states)), dtype=torch.int64)
+    for b in range(4):
+        i, j, k = non_local_boxes.utils.wiring_blocks[b]
+        for state, (t, s) in enumerate(states):
+            keys[b, state] = ((s & 3) << i) + ((s >> 2) << j) + (t << k)
+    return keys
+    # the output is a 4x82 tensor: output[b, s] is the part of the key given by the state s of the block b
+
+
+block_states = reduced_block_states()
+block_keys = reduced_block_keys(block_states)
+
+nb_deterministic_wirings = 12**4 * 2**16          # = 1 358 954 496 feasible deterministic wirings
+nb_reduced_wirings = len(block_states)**4         # = 45 212 176 of them are reduced
+
+
+def deterministic_wiring_keys(start, stop):
+    # Keys of the reduced deterministic wirings number start, ..., stop-1 (in [0, nb_reduced_wirings])
+    index = torch.arange(start, stop, dtype=torch.int64)
+    keys = torch.zeros_like(index)
+    for b in range(4):
+        keys += block_keys[b, index % len(block_states)]
+        index = index // len(block_states)
+    return keys
+    # the output is a int64 tensor with stop-start entries
+
+
+def merge_top_k(values, keys, new_values, new_keys, k):
+    values, keys = torch.cat((values, new_values)), torch.cat((keys, new_keys))
+    values, indices = torch.topk(values, min(k, values.shape[0]))
+    return values, keys[indices]
+
+
+def evaluate_chunk(start, stop, P, Q, k, symmetries):
+    # P and Q are 4x4 matrices
+    keys = deterministic_wiring_keys(start, stop)
+    if symmetries:   # we only keep one wiring per equivalence class
+        keys = keys[non_local_boxes.utils.canonical_keys(keys, symmetries)[0] == keys]
+    with torch.no_grad():
+        values = non_local_boxes.evaluate.phi_flat(non_local_boxes.utils.key_to_wiring(keys), P, Q)
+    values, indices = torch.topk(values, min(k, values.shape[0]))
+    return values, keys[indices]
+
+
+def evaluate_chunk_in_worker(args):
+    return evaluate_chunk(*args)
+
+
+def init_worker(nb_threads):
+    torch.set_num_threads(nb_threads)
+
+
+def save_checkpoint(path, state):
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)   # the previous checkpoint stays valid if we are interrupted while writing
+
+
+def exhaustive_search(P, Q, k=10, symmetries=("outputs",), chunk_size=2**14, nb_workers=1, threads_per_worker=1, checkpoint=None, checkpoint_every=64, stop=nb_reduced_wirings):
+    # P and Q are 4x4 matrices
+    # Computes phi_flat(W, P, Q) for every reduced deterministic wiring W of the feasible set and keeps the k best ones.
+    # The symmetries (see `utils.wiring_symmetries`) are used to evaluate one wiring per equivalence class:
+    # only keep the ones that do not change phi_flat for the given P and Q.
+    # If `checkpoint` is a path, the progress and the current top-k are saved there every `checkpoint_every`
+    # chunks, and a later call with the same path resumes from where it stopped.
+    state = {"P": P, "Q": Q, "k": k, "symmetries": tuple(symmetries), "next": 0, "values": torch.zeros(0), "keys": torch.zeros(0, dtype=torch.int64)}
+    if checkpoint is not None and os.path.exists(checkpoint):
+        state = torch.load(checkpoint)
+        if not (torch.equal(state["P"], P) and torch.equal(state["Q"], Q) and state["k"] == k and state["symmetries"] == tuple(symmetries)):
+            raise ValueError("The checkpoint " + checkpoint + " was computed for other boxes, k or symmetries.")
+
+    starts = range(state["next"], stop, chunk_size)
+    jobs = ((start, min(start+chunk_size, stop), P, Q, k, tuple(symmetries)) for start in starts)
+    if nb_workers > 1:
+        pool = torch.multiprocessing.get_context("spawn").Pool(nb_workers, initializer=init_worker, initargs=(threads_per_worker,))
+        results = pool.imap(evaluate_chunk_in_worker, jobs)   # imap keeps the order, so "next" is always a valid restart point
+    else:
+        pool = None
+        results = map(evaluate_chunk_in_worker, jobs)
+
+    try:
+        for count, (start, (values, keys)) in enumerate(zip(starts, results)):
+            state["values"], state["keys"] = merge_top_k(state["values"], state["keys"], values, keys, k)
+            state["next"] = min(start+chunk_size, stop)
+            if checkpoint is not None and (count+1) % checkpoint_every == 0:
+                save_checkpoint(checkpoint, state)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, state)
+    return state["values"], non_local_boxes.utils.key_to_wiring(state["keys"])
+    # the output is a list of k values, and the 32xk tensor of the corresponding wirings
@@ -1,4 +1,5 @@
 #import numpy as np
+import math
 import torch
 
 #
@@ -150,6 +151,157 @@ def random_wiring(n):  # n is the number of columns
 def random_extremal_wiring(n):  # n is the number of columns
     return torch.randint(2, (32,n))
 
+
+#
+#   Bit-packed deterministic wirings: bit k of the key is the coordinate W[k]
+#
+
+powers_of_two = 2**torch.arange(32, dtype=torch.int64)
+
+def wiring_to_key(W):  # W is a 32xn tensor with 0/1 entries
+    return torch.sum(torch.round(W).long() * powers_of_two.unsqueeze(1), dim=0)
+    # the output is a int64 tensor with n entries
+
+def key_to_wiring(keys):  # keys is a int64 tensor with n entries
+    return ((keys.unsqueeze(0) >> torch.arange(32).unsqueeze(1)) & 1).float()
+    # the output is a 32xn tensor
+
+
+#
+#   Equivalent deterministic wirings
+#
+
+# A wiring is made of 4 blocks: (f1, f2, f3) for x=0 and x=1, and (g1, g2, g3) for y=0 and y=1.
+# wiring_blocks[k] gives the first coordinate of f1 (or g1), f2 (or g2) and f3 (or g3) in the block k.
+wiring_blocks = [(0, 8, 16), (2, 10, 20), (4, 12, 24), (6, 14, 28)]
+
+# In a block, we write s = f1(x,0) + 2 f1(x,1) + 4 f2(x,0) + 8 f2(x,1) and t = sum of 2^(2*a1+a2) f3(x,a1,a2).
+# For non-signaling boxes, f1(x,a2) is irrelevant if f2(x,.) is constant and f3(x,.,a2) does not depend on a1:
+# the output of the first box is not used, so its input can be changed. Similarly for f2(x,a1).
+# block_reduction[t, s] is the smallest state of the block reachable from s by changing irrelevant
+# coordinates, and block_class_size[t, s] is the number of such states.
+block_reduction = torch.zeros((16, 16), dtype=torch.int64)
+block_class_size = torch.zeros((16, 16), dtype=torch.int64)
+for t in range(16):
+    for s in range(16):
+        reached, to_visit = {s}, [s]
+        while to_visit:
+            state = to_visit.pop()
+            bit = [(state >> i) & 1 for i in range(4)]
+            moves = []
+            for a in range(2):
+                if bit[2] == bit[3] and (t >> a) & 1 == (t >> (2+a)) & 1:        # f1(x,a2=a) is irrelevant
+                    moves.append(state ^ (1 << a))
+                if bit[0] == bit[1] and (t >> (2*a)) & 1 == (t >> (2*a+1)) & 1:  # f2(x,a1=a) is irrelevant
+                    moves.append(state ^ (1 << (2+a)))
+            for new_state in moves:
+                if new_state not in reached:
+                    reached.add(new_state)
+                    to_visit.append(new_state)
+        block_reduction[t, s] = min(reached)
+        block_class_size[t, s] = len(reached)
+
+
+def reduce_keys(keys):  # keys is a int64 tensor with n entries (see wiring_to_key)
+    size = torch.ones_like(keys)
+    for i, j, k in wiring_blocks:
+        s = ((keys >> i) & 3) + (((keys >> j) & 3) << 2)
+        t = (keys >> k) & 15
+        s, size = block_reduction[t, s], size * block_class_size[t, s]
+        keys = (keys & ~((3 << i) + (3 << j))) + ((s & 3) << i) + ((s >> 2) << j)
+    return keys, size
+    # the output is the keys of the wirings where the irrelevant coordinates are set to the smallest
+    # possible values (P x_W Q is unchanged for all non-signaling P and Q), and the number of wirings
+    # that are reduced to each key
+
+def reduce_wiring(W):  # W is a 32xn tensor with 0/1 entries
+    keys, size = reduce_keys(wiring_to_key(W))
+    return key_to_wiring(keys), size
+
+
+# Symmetries of the wirings: W is mapped to the wiring W' with W'[i] = W[perm[i]] XOR mask[i].
+#   "outputs":            final outputs a, b -> a+1, b+1 (mod 2). The CHSH values h_flat and h_prime_flat of
+#                         P x_W Q are unchanged for all P and Q.
+#   "first_box_outputs":  outputs a1, b1 of P -> a1+1, b1+1. P x_W Q is unchanged if P is unchanged by this
+#                         relabeling (e.g. PR, SR, I).
+#   "second_box_outputs": outputs a2, b2 of Q -> a2+1, b2+1. Same with Q.
+#   "boxes":              exchange of the roles of P and Q. P x_W Q is unchanged if P = Q.
+#   "parties":            exchange of Alice and Bob. h_flat(P x_W Q) is unchanged if P and Q are symmetric.
+wiring_symmetries = {}
+for name in ["outputs", "first_box_outputs", "second_box_outputs", "boxes", "parties"]:
+    perm, mask = torch.arange(32), torch.zeros(32, dtype=torch.int64)
+    for x in range(2):
+        for a in range(2):
+            for g in range(2):  # g=0 for Alice (f), g=1 for Bob (g)
+                if name == "first_box_outputs":  perm[8+4*g+2*x+a] = 8+4*g+2*x+1-a
+                if name == "second_box_outputs": perm[4*g+2*x+a] = 4*g+2*x+1-a
+                if name == "boxes":
+                    perm[4*g+2*x+a] = 8+4*g+2*x+a
+                    perm[8+4*g+2*x+a] = 4*g+2*x+a
+                if name == "parties":
+                    perm[4*g+2*x+a] = 4*(1-g)+2*x+a
+                    perm[8+4*g+2*x+a] = 8+4*(1-g)+2*x+a
+                for a2 in range(2):
+                    i = 16+8*g+4*x+2*a+a2
+                    if name == "outputs":            mask[i] = 1
+                    if name == "first_box_outputs":  perm[i] = 16+8*g+4*x+2*(1-a)+a2
+                    if name == "second_box_outputs": perm[i] = 16+8*g+4*x+2*a+1-a2
+                    if name == "boxes":              perm[i] = 16+8*g+4*x+2*a2+a
+                    if name == "parties":            perm[i] = 16+8*(1-g)+4*x+2*a+a2
+    wiring_symmetries[name] = (perm, mask)
+
+
+def symmetry_group(symmetries):
+    # symmetries is a list of names of wiring_symmetries
+    # The output is the list of all the compositions of these symmetries, as pairs (perm, mask)
+    identity = (torch.arange(32), torch.zeros(32, dtype=torch.int64))
+    group, to_visit = {(tuple(identity[0].tolist()), tuple(identity[1].tolist())): identity}, [identity]
+    while to_visit:
+        perm1, mask1 = to_visit.pop()
+        for name in symmetries:
+            perm2, mask2 = wiring_symmetries[name]
+            element = (perm1[perm2], mask1[perm2] ^ mask2)   # first apply (perm1, mask1), then (perm2, mask2)
+            label = (tuple(element[0].tolist()), tuple(element[1].tolist()))
+            if label not in group:
+                group[label] = element
+                to_visit.append(element)
+    return list(group.values())
+
+
+def permute_keys(keys, perm, mask):  # keys is a int64 tensor with n entries
+    # The bits are moved with one lookup table per byte of the keys
+    values = torch.arange(256, dtype=torch.int64)
+    tables = torch.zeros((4, 256), dtype=torch.int64)
+    for i in range(32):
+        tables[perm[i] // 8] += ((values >> (perm[i] % 8)) & 1) << i
+    new_keys = torch.sum(powers_of_two.unsqueeze(1) * mask.unsqueeze(1), dim=0)
+    for byte in range(4):
+        new_keys = new_keys ^ tables[byte, (keys >> (8*byte)) & 255]
+    return new_keys
+
+
+def canonical_keys(keys, symmetries=("outputs",)):  # keys is a int64 tensor with n entries
+    # Two deterministic wirings are equivalent if one is obtained from the other by changing irrelevant
+    # coordinates (see reduce_keys) and by applying the given symmetries (see wiring_symmetries).
+    all_keys, size = [], None
+    for perm, mask in symmetry_group(symmetries):
+        new_keys, new_size = reduce_keys(permute_keys(keys, perm, mask))
+        all_keys.append(new_keys)
+        size = new_size if size is None else size
+    all_keys = torch.sort(torch.stack(all_keys), dim=0).values
+    nb_classes = 1 + torch.sum(all_keys[1:] != all_keys[:-1], dim=0)   # number of distinct reduced wirings in the orbit
+    return all_keys[0], nb_classes * size
+    # the output is the keys of the canonical representatives (the smallest keys), and the number of
+    # wirings equivalent to each key
+
+def canonical_wirings(W, symmetries=("outputs",)):  # W is a 32xn tensor with 0/1 entries
+    keys, size = canonical_keys(wiring_to_key(W), symmetries)
+    return key_to_wiring(keys), size
+
+def canonical_wiring(W, symmetries=("outputs",)):  # W is a list (with 32 entries), or a 32x1 tensor
+    W, size = canonical_wirings(torch.reshape(torch.as_tensor(W, dtype=torch.float32), (32, 1)), symmetries)
+    return W[:, 0], int(size[0])
+
 def print_functions_from_wiring(W):  
     # BE CAREFUL!! Here W is a list (with 32 entries), or a 32x1 tensor
     # f1
@@ -368,92 +520,83 @@ def projection_to_extremal_wiring(W): # W is a torch.tensor
 
 
 #
-#  Function to project a wiring W in the feasible set \mathcal{W}
+#   Algebraic normal form (over GF(2)) of the wirings
 #
 
-M1 = torch.zeros(32, 32)
-for i in range(32):
-    M1[i,i]=1
-M1[0,0]=0.5
-M1[0,1]=0.5
-M1[1,0]=0.5
-M1[1,1]=0.5
-
-M2 = torch.zeros(32, 32)
-for i in range(32):
-    M2[i,i]=1
-M2[8,8]=0.5
-M2[8,9]=0.5
-M2[9,8]=0.5
-M2[9,9]=0.5
-
-M3 = torch.zeros(32, 32)
-for i in range(32):
-    M3[i,i]=1
-M3[2,2]=0.5
-M3[2,3]=0.5
-M3[3,2]=0.5
-M3[3,3]=0.5
-
-M4 = torch.zeros(32, 32)
-for i in range(32):
-    M4[i,i]=1
-M4[10,10]=0.5
-M4[10,11]=0.5
-M4[11,10]=0.5
-M4[11,11]=0.5
-
-M5 = torch.zeros(32, 32)
-for i in range(32):
-    M5[i,i]=1
-M5[4,4]=0.5
-M5[4,5]=0.5
-M5[5,4]=0.5
-M5[5,5]=0.5
-
-M6 = torch.zeros(32, 32)
-for i in range(32):
-    M6[i,i]=1
-M6[12,12]=0.5
-M6[12,13]=0.5
-M6[13,12]=0.5
-M6[13,13]=0.5
-
-M7 = torch.zeros(32, 32)
-for i in range(32):
-    M7[i,i]=1
-M7[6,6]=0.5
-M7[6,7]=0.5
-M7[7,6]=0.5
-M7[7,7]=0.5
-
-M8 = torch.zeros(32, 32)
-for i in range(32):
-    M8[i,i]=1
-M8[14,14]=0.5
-M8[14,15]=0.5
-M8[15,14]=0.5
-M8[15,15]=0.5
-
-def projected_wiring(W):  # W is a 32xn tensor
-    W = torch.maximum(W, torch.zeros_like(W))  # it outputs the element-wise maximum
-    W = torch.minimum(W, torch.ones_like(W))   # similarly for minimum
-
-    T1 = (torch.abs(W[0,:]-W[1,:]) <= torch.abs(W[8, :] - W[9, :]))
-    W = T1*torch.tensordot(M1, W, dims=1) + torch.logical_not(T1)*torch.tensordot(M2, W, dims=1)
-    
-    T2 = (torch.abs(W[2,:]-W[3,:]) <= torch.abs(W[10, :] - W[11, :]))
-    W = T2*torch.tensordot(M3, W, dims=1) + torch.logical_not(T2)*torch.tensordot(M4, W, dims=1)
+# The ANF of a deterministic wiring is written in the same layout as W: the coordinate start+m is the
+# coefficient of the monomial m of the function, where m is read as the coordinates of W (x = 2, a2 = 1 for
+# f1, x = 2, a1 = 1 for f2, and x = 4, a1 = 2, a2 = 1 for f3, similarly for g1, g2, g3), following the layout
+# of functions_to_wiring (print_functions_from_wiring labels the monomials x.a1 and x.a2 of f3 and g3
+# differently). Each coefficient is the sum mod 2 of the values on the submonomials.
+function_names = ["f1", "g1", "f2", "g2", "f3", "g3"]
+function_slices = [(0, 4), (4, 8), (8, 12), (12, 16), (16, 24), (24, 32)]
+
+anf_matrix = torch.zeros((32, 32))
+anf_monomials = torch.zeros((32, 3))   # for each coordinate of the ANF, the variables (x, a1, a2) of its monomial
+for start, stop in function_slices:
+    for m in range(stop-start):
+        for s in range(stop-start):
+            if s & m == s:
+                anf_matrix[start+m, start+s] = 1
+        if stop-start == 8:
+            anf_monomials[start+m] = torch.tensor([(m >> 2) & 1, (m >> 1) & 1, m & 1])
+        else:
+            anf_monomials[start+m, 0] = (m >> 1) & 1
+            anf_monomials[start+m, 1 if start in (8, 12) else 2] = m & 1
+anf_degrees_of_monomials = torch.sum(anf_monomials, dim=1)
+
+def wiring_anf(W):  # W is a 32xn tensor (rounded to a deterministic wiring)
+    return torch.remainder(torch.mm(anf_matrix, torch.round(W.detach()).float()).long(), 2)
+    # the output is a 32xn int64 tensor with 0/1 entries (see above for the layout)
+
+def anf_degrees(A):  # A is the 32xn output of wiring_anf
+    D = A * anf_degrees_of_monomials.long().unsqueeze(1)
+    return torch.stack([torch.max(D[start:stop], dim=0).values for start, stop in function_slices])
+    # the output is a 6xn tensor: the degree of f1, g1, f2, g2, f3, g3 (0 if the function is constant)
+
+def anf_dependencies(A):  # A is the 32xn output of wiring_anf
+    return torch.stack([torch.mm(anf_monomials[start:stop].t(), A[start:stop].float()) > 0 for start, stop in function_slices])
+    # the output is a boolean 6x3xn tensor: whether f1, g1, f2, g2, f3, g3 depend on their input (x or y), on
+    # the output of the first box (a1 or b1) and on the output of the second box (a2 or b2)
+
+def is_BS09_type(A):  # A is the 32xn output of wiring_anf
+    # Same structure as W_BS09: f1 depends only on x, f2 contains the monomial x.a1, and f3 is affine and depends
+    # on both a1 and a2 (and similarly for g1, g2, g3)
+    D, degrees = anf_dependencies(A), anf_degrees(A)
+    first = D[0:2, 0] & ~D[0:2, 1] & ~D[0:2, 2]
+    second = A[[11, 15]] == 1
+    last = (degrees[4:6] == 1) & D[4:6, 1] & D[4:6, 2]
+    return torch.all(first & second & last, dim=0)
+    # the output is a boolean tensor with n entries
 
-    T3 = (torch.abs(W[4,:]-W[5,:]) <= torch.abs(W[12, :] - W[13, :]))
-    W = T3*torch.tensordot(M5, W, dims=1) + torch.logical_not(T3)*torch.tensordot(M6, W, dims=1)
 
-    T4 = (torch.abs(W[6,:]-W[7,:]) <= torch.abs(W[14, :] - W[15, :]))
-    W = T4*torch.tensordot(M7, W, dims=1) + torch.logical_not(T4)*torch.tensordot(M8, W, dims=1)
+#
+#  Function to project a wiring W in the feasible set \mathcal{W}
+#
 
+# For each x, the pair f1(x,0), f1(x,1) (coordinates 0-1 or 2-3) is compared with the pair f2(x,0), f2(x,1)
+# (coordinates 8-9 or 10-11), and the pair with the smallest difference is replaced by its mean: then f1(x,.)
+# or f2(x,.) is constant. Similarly for g1 (coordinates 4-7) and g2 (coordinates 12-15).
+
+def projected_wiring(W, out=None):  # W is a 32xn tensor
+    # If out is given (a 32xn tensor, possibly W itself), the projection is written there
+    W = torch.clamp(W, 0, 1, out=out)
+    first = W[0:8].view(4, 2, -1)     # f1 and g1, by pairs
+    second = W[8:16].view(4, 2, -1)   # f2 and g2, by pairs
+    T = torch.unsqueeze(torch.abs(first[:, 0]-first[:, 1]) <= torch.abs(second[:, 0]-second[:, 1]), 1)
+    first_mean, second_mean = first.mean(dim=1, keepdim=True), second.mean(dim=1, keepdim=True)
+    first.copy_(torch.where(T, first_mean, first))
+    second.copy_(torch.where(T, second, second_mean))
     return W
 
 
+def projected_step(W, alpha, gradient, out=None):
+    # W and gradient are 32xn tensors, alpha is a tensor with n entries (or a number)
+    # Same as projected_wiring(W + alpha*gradient), without intermediate 32xn tensors
+    out = torch.addcmul(W, gradient, torch.as_tensor(alpha), out=out)
+    return projected_wiring(out, out=out)
+
+
 
 
 
@@ -461,16 +604,16 @@ def projected_wiring(W):  # W is a 32xn tensor
 #   Link between MATRICES and TENSORS
 #
 
-def matrix_to_tensor(Matrix):
-    T = torch.reshape(Matrix, (2,2,2,2))
+def matrix_to_tensor(Matrix):  # Matrix is a 4x4 matrix, or a 4x4xn tensor
+    T = torch.reshape(Matrix, (2,2,2,2) + Matrix.shape[2:])
     T = torch.transpose(T, 0, 2)
     T = torch.transpose(T, 1, 3)
     return T
 
-def tensor_to_matrix(Tensor):
+def tensor_to_matrix(Tensor):  # Tensor is a 2x2x2x2 tensor, or a 2x2x2x2xn tensor
     M = torch.transpose(Tensor, 0, 2)
     M = torch.transpose(M, 1, 3)
-    return torch.reshape(M, (4,4))
+    return torch.reshape(M, (4,4) + Tensor.shape[4:])
 
 
 
@@ -535,6 +678,9 @@ for a in range(2):
 
 CHSH_flat = matrix_to_tensor( CHSH ).flatten()
 
+# A box winning CHSH with a probability larger than this value collapses communication complexity [BBLMTU06]
+BBLMTU_value = (3+math.sqrt(6))/6
+
 
 CHSH_prime = torch.zeros((4,4))
 
@@ -547,6 +693,47 @@ for a in range(2):
 
 CHSH_prime_flat = matrix_to_tensor( CHSH_prime ).flatten()
 
+
+#
+#  Registry of games
+#
+
+# A game is given by a Boolean predicate on (a,b,x,y), evaluated on the 16 entries at once: a, b, x, y are
+# tensors, so the predicate must use &, | and ~ instead of and, or and not. Its flat tensor (in the layout
+# of CHSH_flat) is 1/4 where the predicate is true. The lists game_names and game_rows are only modified in
+# place (so that they are also up to date in the `non_local_boxes` namespace), and registered_games() stacks
+# the rows.
+
+game_inputs = torch.reshape(torch.stack(torch.meshgrid(*(torch.arange(2),)*4, indexing="ij")), (4, 16))   # rows a, b, x, y
+
+def game_flat(predicate):
+    a, b, x, y = game_inputs
+    return 0.25*torch.as_tensor(predicate(a, b, x, y)).float()
+    # the output is a tensor with 16 entries
+
+game_names = []
+game_rows = []
+
+def register_game(name, predicate):
+    flat = game_flat(predicate)
+    if name in game_names:
+        game_rows[game_names.index(name)] = flat
+    else:
+        game_names.append(name)
+        game_rows.append(flat)
+
+def registered_games():
+    return torch.stack(game_rows)
+    # the output is a Gx16 tensor: the registered games, in the order of game_names
+
+def game_index(name):
+    return game_names.index(name)
+
+register_game("CHSH", lambda a, b, x, y: (a+b) % 2 == x*y)
+register_game("CHSH_prime", lambda a, b, x, y: (a+b) % 2 == (x+1)*(y+1) % 2)
+register_game("CHSH_second", lambda a, b, x, y: (a+b) % 2 == x*(y+1) % 2)
+register_game("MyGame", lambda a, b, x, y: (a == 0) & (b == y))
+
 #
 #  Which boxes do we test?
 #
@@ -0,0 +1,23 @@
+import math
+import torch
+import non_local_boxes.accumulator
+
+
+def test_empty_accumulator():
+    accumulator = non_local_boxes.accumulator.Accumulator()
+    assert accumulator.count == 0
+    assert math.isnan(accumulator.mean())
+    assert math.isnan(accumulator.quantile(0.5))
+
+
+def test_merge_into_empty_accumulator():
+    values = torch.tensor([0.2, 0.4, 0.6])
+    accumulator = non_local_boxes.accumulator.Accumulator()
+    accumulator.update(values, torch.zeros(32, 3))
+    merged = non_local_boxes.accumulator.Accumulator().merge(accumulator)
+    assert merged.count == 3
+    assert math.isclose(merged.mean(), 0.4, rel_tol=1e-6)
+    assert abs(merged.quantile(0.5) - 0.4) <= 1/2**16
+    merged.merge(non_local_boxes.accumulator.Accumulator())
+    assert merged.count == 3
+    assert math.isclose(merged.mean(), 0.4, rel_tol=1e-6)